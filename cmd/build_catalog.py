@@ -0,0 +1,24 @@
+'''
+Build or update the catalog of the edX data directory (or of the
+directory given on the commandline), so `read_data` can skip files
+which can't have the events we're after.
+
+Only new or changed files are scanned, so this is cheap to run from
+cron as logs come in.
+'''
+
+import sys
+
+import xanalytics.settings as settings
+import xanalytics.streaming as streaming
+
+from xanalytics.gzipfs import GZIPFS
+
+if len(sys.argv) > 1:
+    filesystem = GZIPFS(sys.argv[1])
+else:
+    filesystem = settings.edxdatafs()
+
+catalog = streaming.build_catalog(filesystem)
+lines = sum(entry['lines'] for entry in catalog.values())
+print len(catalog), "files,", lines, "lines"
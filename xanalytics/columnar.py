@@ -0,0 +1,340 @@
+'''
+Columnar (Parquet) storage for flattened events.
+
+Most of our aggregations only look at a handful of fields, but
+reading JSON or BSON means decoding every field of every event, on
+every run. Here, we convert a stream of events once into Parquet
+files, partitioned (by default) by date and course:
+
+    data = read_data(edxdatafs(), format="json")
+    write_columns(data, scratchfs("columns", compress=False))
+
+and then load just the columns we need, as NumPy arrays:
+
+    columns = read_columns(scratchfs("columns", compress=False),
+                           ["username", "event_type"],
+                           lambda p: p["course_id"] == course)
+
+Column names are the keys from `streaming.flatten` (e.g.
+`context.course_id`). Lists are stored as JSON strings.
+
+This relies on pyarrow and numpy, which are optional.
+'''
+
+import json
+import urllib
+
+try:
+    import numpy
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    numpy = None
+    pyarrow = None
+
+from xanalytics.streaming import flatten, time_key, _open_raw
+
+
+def _date(event):
+    '''
+    Helper: The (UTC) date of a flattened event, or None.
+
+    >>> _date({'time': '2014-01-02T23:30:00-05:00'})
+    '2014-01-03'
+    >>> _date({'time': 'garbage'}) is None
+    True
+    '''
+    try:
+        return time_key(event['time'])[:10]
+    except (KeyError, ValueError, TypeError, OverflowError):
+        return None
+
+
+# Partition names we know how to compute from a flattened
+# event. Other names are taken as field names.
+_PARTITION_KEYS = {
+    'date': _date,
+    'course_id': lambda event: event.get('context.course_id'),
+}
+
+# The directory name for a partition with no value (as in Hive), so
+# None doesn't come back as the string 'None'
+_MISSING_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+
+def _require_pyarrow():
+    if pyarrow is None:
+        raise ImportError("Columnar storage needs pyarrow and numpy")
+
+
+def _partition_value(event, name):
+    '''
+    Helper: Find the value of a partition for a flattened event.
+
+    >>> _partition_value({'time': '2014-01-02T03:04:05'}, 'date')
+    '2014-01-02'
+    >>> _partition_value({'username': 'bob'}, 'username')
+    'bob'
+    '''
+    if name in _PARTITION_KEYS:
+        return _PARTITION_KEYS[name](event)
+    return event.get(name)
+
+
+def partition_path(partition_by, values):
+    '''
+    Return the directory for a partition. Values are quoted, since
+    course IDs have slashes in them. Missing (None) values are
+    written as `_MISSING_PARTITION`.
+
+    >>> partition_path(['date', 'course_id'],
+    ...                ['2014-01-02', 'MITx/6.002x/2012'])
+    'date=2014-01-02/course_id=MITx%2F6.002x%2F2012'
+    >>> partition_path(['course_id'], [None])
+    'course_id=__HIVE_DEFAULT_PARTITION__'
+    '''
+    return "/".join("{name}={value}".format(
+        name=name,
+        value=_MISSING_PARTITION if value is None else
+        urllib.quote(unicode(value).encode('utf-8'), safe=''))
+        for (name, value) in zip(partition_by, values))
+
+
+def parse_partition_path(path):
+    '''
+    The reverse of partition_path. Returns a dictionary.
+
+    >>> parse_partition_path('date=2014-01-02/course_id=MITx%2F6.002x')
+    {'date': '2014-01-02', 'course_id': 'MITx/6.002x'}
+    >>> parse_partition_path('course_id=__HIVE_DEFAULT_PARTITION__')
+    {'course_id': None}
+    '''
+    partition = {}
+    for part in path.strip("/").split("/"):
+        if "=" in part:
+            (name, value) = part.split("=", 1)
+            partition[name] = None if value == _MISSING_PARTITION else \
+                urllib.unquote(value)
+    return partition
+
+
+def _column_values(rows, field):
+    '''
+    Helper: Pull one column out of a list of flattened events. Lists
+    and other non-scalars become JSON strings, so Arrow can type the
+    column.
+    '''
+    values = []
+    for row in rows:
+        value = row.get(field)
+        if isinstance(value, (list, dict)):
+            value = json.dumps(value)
+        values.append(value)
+    return values
+
+
+def _write_partition(filesystem, directory, part, rows):
+    '''
+    Helper: Write one Parquet file with the rows of one partition.
+    '''
+    fields = sorted(set().union(*(row.keys() for row in rows)))
+    arrays = []
+    for field in fields:
+        values = _column_values(rows, field)
+        try:
+            arrays.append(pyarrow.array(values))
+        except (pyarrow.ArrowException, TypeError, ValueError):
+            # Mixed types. Fall back to strings.
+            arrays.append(pyarrow.array(
+                [None if v is None else unicode(v) for v in values]))
+    table = pyarrow.Table.from_arrays(arrays, fields)
+    filesystem.makedir(directory, recursive=True, allow_recreate=True)
+    fp = _open_raw(filesystem,
+                   "{dir}/part-{part}.parquet".format(dir=directory,
+                                                      part=part),
+                   'wb')
+    pyarrow.parquet.write_table(table, fp)
+    fp.close()
+
+
+def _next_part(filesystem, directory):
+    '''
+    Helper: The number for the next part in a partition directory:
+    one past the highest there already, so we add to what earlier
+    runs wrote rather than replacing it.
+    '''
+    if not filesystem.exists(directory):
+        return 0
+    numbers = [int(name[len("part-"):-len(".parquet")])
+               for name in filesystem.listdir(directory,
+                                              wildcard="part-*.parquet")]
+    return max(numbers) + 1 if numbers else 0
+
+
+def write_columns(data,
+                  filesystem,
+                  partition_by=('date', 'course_id'),
+                  rows_per_file=100000,
+                  max_rows=1000000):
+    '''
+    Write a stream of events (dictionaries) as partitioned Parquet
+    files. Events are flattened first. Returns the number of events
+    written. Writing to an existing store adds to it.
+
+    A partition is written out when it has `rows_per_file` events.
+    We also hold at most `max_rows` events in total; past that, we
+    write out the largest partitions until we're down to half of it.
+
+    `filesystem` should not compress (e.g. `compress=False` from
+    settings); Parquet compresses on its own.
+
+    >>> import fs.memoryfs
+    >>> store = fs.memoryfs.MemoryFS()
+    >>> events = [{"time": "2014-01-0%dT00:00:00" % (1 + i % 2),
+    ...            "username": "user%d" % i,
+    ...            "context": {"course_id": "MITx/6.002x/2012"}}
+    ...           for i in range(20)]
+    >>> write_columns(events, store, max_rows=4)
+    20
+    >>> write_columns(events[:2], store)
+    2
+    >>> columns = read_columns(store, ["username", "context.course_id"],
+    ...                        lambda p: p["date"] == "2014-01-01")
+    >>> sorted(columns["username"])[:3]
+    ['user0', 'user0', 'user10']
+    >>> len(columns["context.course_id"])
+    11
+    >>> write_columns([{"time": "2014-01-01T00:00:00", "username": "eve"}],
+    ...               store)
+    1
+    >>> list(read_columns(store, ["username"],
+    ...                   lambda p: p["course_id"] is None)["username"])
+    ['eve']
+    '''
+    _require_pyarrow()
+    buffers = {}
+    parts = {}
+    count = 0
+
+    def flush(values):
+        directory = partition_path(partition_by, values)
+        if values not in parts:
+            parts[values] = _next_part(filesystem, directory)
+        _write_partition(filesystem,
+                         directory,
+                         parts[values],
+                         buffers.pop(values))
+        parts[values] = parts[values] + 1
+
+    buffered = 0
+    for event in data:
+        event = flatten(event)
+        values = tuple(_partition_value(event, name) for name in partition_by)
+        buffers.setdefault(values, []).append(event)
+        buffered = buffered + 1
+        if len(buffers[values]) >= rows_per_file:
+            buffered = buffered - len(buffers[values])
+            flush(values)
+        if buffered > max_rows:
+            for largest in sorted(buffers,
+                                  key=lambda values: len(buffers[values]),
+                                  reverse=True):
+                buffered = buffered - len(buffers[largest])
+                flush(largest)
+                if buffered <= max_rows / 2:
+                    break
+        count = count + 1
+    for values in buffers.keys():
+        flush(values)
+    return count
+
+
+def list_partitions(filesystem, predicate=None):
+    '''
+    Yield (partition, path) for all Parquet files in a columnar
+    store. `partition` is a dictionary of partition values. If
+    `predicate` is given, only files where predicate(partition) is
+    true are returned, and we never open the rest.
+    '''
+    for path in sorted(filesystem.walkfiles(wildcard="*.parquet")):
+        partition = parse_partition_path(path.rsplit("/", 1)[0])
+        if predicate is None or predicate(partition):
+            yield (partition, path)
+
+
+def _combine(chunks):
+    '''
+    Helper: Combine Arrow arrays from different files into one chunked
+    array. Files which were missing the column give null arrays; those
+    take on the type of the others. If files disagree on the type, we
+    fall back to strings. With no chunks at all, the array is empty.
+    '''
+    if not chunks:
+        return pyarrow.chunked_array([], pyarrow.null())
+    types = set(chunk.type for chunk in chunks
+                if chunk.type != pyarrow.null())
+    if len(types) == 1:
+        column_type = types.pop()
+        chunks = [pyarrow.array([None] * len(chunk), column_type)
+                  if chunk.type == pyarrow.null() else chunk
+                  for chunk in chunks]
+    elif len(types) > 1:
+        chunks = [pyarrow.array([None if v is None else unicode(v)
+                                 for v in chunk.to_pylist()],
+                                pyarrow.string())
+                  for chunk in chunks]
+    return pyarrow.chunked_array(chunks, chunks[0].type)
+
+
+def read_columns(filesystem, fields, predicate=None, arrow=False):
+    '''
+    Load columns from a columnar store. Returns a dictionary mapping
+    each field in `fields` to an array with one entry per event.
+
+    Only the Parquet files in partitions where `predicate(partition)`
+    is true are read (see `list_partitions`), and only the requested
+    columns are decoded.
+
+    We return NumPy arrays, or if `arrow` is set, Arrow chunked
+    arrays. Missing values are None (NaN for numeric NumPy columns).
+    If no partitions match, the arrays are empty.
+
+    >>> import fs.memoryfs
+    >>> empty = read_columns(fs.memoryfs.MemoryFS(), ["username"],
+    ...                      lambda p: p["course_id"] == "Not/A/Course")
+    >>> len(empty["username"])
+    0
+    '''
+    _require_pyarrow()
+    chunks = dict((field, []) for field in fields)
+    for (partition, path) in list_partitions(filesystem, predicate):
+        fp = _open_raw(filesystem, path)
+        parquet_file = pyarrow.parquet.ParquetFile(fp)
+        available = set(parquet_file.schema.names)
+        table = parquet_file.read(columns=[f for f in fields
+                                           if f in available])
+        for field in fields:
+            if field in available:
+                chunks[field].extend(table.column(field).chunks)
+            else:
+                chunks[field].append(pyarrow.array(
+                    [None] * parquet_file.metadata.num_rows))
+        fp.close()
+
+    columns = dict((field, _combine(chunks[field])) for field in fields)
+    if arrow:
+        return columns
+    arrays = {}
+    for (field, column) in columns.items():
+        if column.num_chunks:
+            arrays[field] = numpy.concatenate(
+                [chunk.to_numpy(zero_copy_only=False)
+                 for chunk in column.chunks])
+        else:
+            arrays[field] = numpy.array([], dtype=object)
+    return arrays
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -7,12 +7,26 @@ compressed files.
 
 This is unfinished code: 
 
-* This is a copy of fs.osfs with gzip.open instead of open. We shouldn't copy 
-  code. It should wrap around any pyfs object (GZIPFS(OSFS('/tmp/tmp'))). This
-  will change signatures slightly. 
+* This is a copy of fs.osfs with compression added. `CompressedFS` does the
+  same as a wrapper around any pyfs object (CompressedFS(OSFS('/tmp/tmp'))).
+  GZIPFS is kept for its system paths, xattrs, and change watching, which
+  the rest of the code relies on.
 * It's very untested. It works in a few contexts, but full pyfs functionality 
   may be broken in places. 
 
+Despite the name, files can be written with any of the codecs in
+`codecs` (gzip, zstd, lz4, or none), at a given level, with a given
+number of threads (gzip is then written pigz-style, as one member per
+block, compressed in parallel). Reads detect the codec from the first
+bytes of the file, so a directory can hold a mix.
+
+Gzip files are opened for reading as `seekable.SeekableGzipFile`s, so seeks
+don't decompress from the start of the file. `gzip_index` finds the
+gzip members of a file, and caches them in an xattr (or a hidden
+`.<name>.gzi` file next to it), which makes seeks faster still, and
+gives the uncompressed size. Indexes are only built when asked for;
+`getsize` is the size on disk.
+
 For example, to print all the files and directories in the OS root::
 
     >>> from xanalytics.gzipfs import GZIPFS
@@ -30,15 +44,22 @@ import datetime
 import platform
 import io
 import shutil
-import gzip
+import json
 
 from fs.base import *
 from fs.path import *
 from fs.errors import *
 from fs import _thread_synchronize_default
 
+from xanalytics.gzipfs import codecs
+from xanalytics.gzipfs.compressedfs import CompressedFS
 from xanalytics.gzipfs.xattrs import GZIPFSXAttrMixin
 from xanalytics.gzipfs.watch import GZIPFSWatchMixin
+from xanalytics.gzipfs.seekable import build_index
+
+# Where we cache gzip indexes
+_INDEX_XATTR = 'user.xanalytics.gzindex'
+_INDEX_EXTENSION = '.gzi'
 
 
 @convert_os_errors
@@ -102,7 +123,11 @@ class GZIPFS(GZIPFSXAttrMixin, GZIPFSWatchMixin, FS):
     else:
         _meta["invalid_path_chars"] = '\0'
 
-    def __init__(self, root_path, thread_synchronize=_thread_synchronize_default, encoding=None, create=False, dir_mode=0700, use_long_paths=True):
+    def __init__(self, root_path,
+                 thread_synchronize=_thread_synchronize_default,
+                 encoding=None, create=False, dir_mode=0700,
+                 use_long_paths=True, codec='gzip', level=None,
+                 threads=None, block_size=None):
         """
         Creates an FS object that represents the OS Filesystem under a given root path
 
@@ -111,10 +136,21 @@ class GZIPFS(GZIPFSXAttrMixin, GZIPFSWatchMixin, FS):
         :param encoding: The encoding method for path strings
         :param create: If True, then root_path will be created if it doesn't already exist
         :param dir_mode: The mode to use when creating the directory
+        :param codec: The codec to write files with ('gzip', 'zstd', 'lz4',
+            or None)
+        :param level: The compression level
+        :param threads: The number of threads to compress with
+        :param block_size: The bytes compressed by each thread at a time
+            (gzip only)
 
         """
 
         super(GZIPFS, self).__init__(thread_synchronize=thread_synchronize)
+        codecs.check(codec)
+        self.codec = codec
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
         self.encoding = encoding or sys.getfilesystemencoding()
         self.dir_mode = dir_mode
         self.use_long_paths = use_long_paths
@@ -229,7 +265,16 @@ class GZIPFS(GZIPFSXAttrMixin, GZIPFSWatchMixin, FS):
         mode = ''.join(c for c in mode if c in 'rwabt+')
         sys_path = self.getsyspath(path)
         try:
-            return gzip.open(sys_path, mode=mode)
+            if '+' in mode:
+                raise UnsupportedError("open for reading and writing")
+            if 'r' in mode:
+                return codecs.reader(open(sys_path, 'rb'),
+                                     self._cached_index(path))
+            return codecs.writer(open(sys_path, mode.replace('t', '') + 'b'),
+                                 self.codec,
+                                 self.level,
+                                 self.threads,
+                                 self.block_size)
         except EnvironmentError, e:
             #  Win32 gives EACCES when opening a directory.
             if sys.platform == "win32" and e.errno in (errno.EACCES,):
@@ -384,4 +429,63 @@ class GZIPFS(GZIPFSXAttrMixin, GZIPFSWatchMixin, FS):
 
     @convert_os_errors
     def getsize(self, path):
+        """The size of a file on disk, as with getinfo. This is cheap,
+        and has no side effects. For the uncompressed size of a gzip
+        file, see `gzip_index`."""
         return self._stat(path).st_size
+
+    def _index_path(self, path):
+        """Helper: Where we cache the index of a file, without xattrs."""
+        (directory, name) = pathsplit(path)
+        return pathjoin(directory, "." + name + _INDEX_EXTENSION)
+
+    def _cached_index(self, path):
+        """Helper: Return the cached gzip index of a file, or None if there
+        isn't one, or the file changed since it was made."""
+        stats = self._stat(path)
+        index = None
+        try:
+            index = self.getxattr(path, _INDEX_XATTR)
+        except UnsupportedError:
+            pass
+        if index is None:
+            try:
+                index = open(self.getsyspath(self._index_path(path))).read()
+            except IOError:
+                return None
+        index = json.loads(index)
+        if (index['size'], index['mtime']) != (stats.st_size,
+                                                stats.st_mtime):
+            return None
+        return index
+
+    @convert_os_errors
+    def gzip_index(self, path):
+        """Return the index of a gzip file (see `seekable.build_index`).
+        If it isn't cached, we build it, and try to cache it in an xattr,
+        or else in a hidden file next to it."""
+        index = self._cached_index(path)
+        if index is not None:
+            return index
+        stats = self._stat(path)
+        fp = open(self.getsyspath(path), 'rb')
+        try:
+            index = build_index(fp)
+        finally:
+            fp.close()
+        index['size'] = stats.st_size
+        index['mtime'] = stats.st_mtime
+        encoded = json.dumps(index)
+        try:
+            self.setxattr(path, _INDEX_XATTR, encoded)
+            return index
+        except (UnsupportedError, OperationFailedError, StorageSpaceError):
+            pass
+        try:
+            fp = open(self.getsyspath(self._index_path(path)), 'w')
+            fp.write(encoded)
+            fp.close()
+        except IOError:
+            pass  # Read-only; we just won't cache it
+        return index
+
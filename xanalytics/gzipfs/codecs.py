@@ -0,0 +1,510 @@
+"""
+xanalytics.gzipfs.codecs
+========================
+
+Compression codecs. gzip is always available. zstd and lz4 are used
+if the `zstandard` and `lz4` modules are installed; they are several
+times faster than gzip.
+
+Codecs are named by strings ('gzip', 'zstd', 'lz4'). None means no
+compression.
+
+    >>> decompress(compress("hello", "gzip"), "gzip")
+    'hello'
+    >>> detect(compress("hello", "gzip"))
+    'gzip'
+    >>> detect("hello") is None
+    True
+
+For files, `writer` wraps a file object to compress what is written
+to it, and `reader` wraps one to decompress it, whatever the codec:
+
+    >>> import StringIO
+    >>> raw = StringIO.StringIO()
+    >>> raw.close = lambda: None
+    >>> f = writer(raw, "gzip")
+    >>> f.write("hello\\nworld\\n")
+    >>> f.close()
+    >>> _ = raw.seek(0)
+    >>> list(reader(raw))
+    ['hello\\n', 'world\\n']
+"""
+
+import collections
+import multiprocessing
+import multiprocessing.pool
+import os
+import threading
+import zlib
+
+from xanalytics.gzipfs.seekable import SeekableGzipFile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+CODECS = ('gzip', 'zstd', 'lz4', None)
+
+EXTENSIONS = {'gzip': '.gz',
+              'zstd': '.zst',
+              'lz4': '.lz4',
+              None: ''}
+
+MAGIC = {'gzip': '\x1f\x8b',
+         'zstd': '\x28\xb5\x2f\xfd',
+         'lz4': '\x04\x22\x4d\x18'}
+
+
+def available(codec):
+    """Return True if we have the library for a codec."""
+    if codec == 'zstd':
+        return zstandard is not None
+    elif codec == 'lz4':
+        return lz4 is not None
+    return codec in CODECS
+
+
+def check(codec):
+    """Raise an error if a codec is unknown or its library is missing."""
+    if codec not in CODECS:
+        raise AttributeError("Unknown codec: " + repr(codec))
+    if not available(codec):
+        raise ImportError("The %s codec needs a module which isn't "
+                          "installed" % codec)
+
+
+def detect(header):
+    """Guess the codec from the first bytes of a file. Returns None if
+    it doesn't look compressed."""
+    for codec in ('gzip', 'zstd', 'lz4'):
+        if header.startswith(MAGIC[codec]):
+            return codec
+    return None
+
+
+def compress(data, codec, level=None):
+    """Compress a string. Each call gives a complete gzip member (or
+    zstd/lz4 frame), so the results can be concatenated."""
+    check(codec)
+    if codec == 'gzip':
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        compressor = zlib.compressobj(level,
+                                      zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    elif codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level or 3).compress(data)
+    elif codec == 'lz4':
+        return lz4.frame.compress(data, compression_level=level or 0)
+    return data
+
+
+def decompress(data, codec):
+    """Decompress a string holding one gzip member (or zstd/lz4 frame)."""
+    check(codec)
+    if codec == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    elif codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec == 'lz4':
+        return lz4.frame.decompress(data)
+    return data
+
+
+# Bytes read or decompressed at a time
+_CHUNK_SIZE = 64 * 1024
+
+
+class _Lz4Compressor(object):
+    """Helper: Give lz4 frames the same interface as zlib."""
+    def __init__(self, level):
+        self.compressor = lz4.frame.LZ4FrameCompressor(
+            compression_level=level or 0)
+        self.started = False
+
+    def compress(self, data):
+        if not self.started:
+            self.started = True
+            return self.compressor.begin() + self.compressor.compress(data)
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compress('') + self.compressor.flush()
+
+
+def compressor(codec, level=None, threads=None):
+    """Return an object with compress(data) and flush() methods, as
+    with zlib.compressobj, which makes one gzip member (or zstd/lz4
+    frame). `threads` is only used by zstd."""
+    check(codec)
+    if codec == 'gzip':
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level or 3,
+                                        threads=threads or 0).compressobj()
+    elif codec == 'lz4':
+        return _Lz4Compressor(level)
+    raise AttributeError("Can't stream with no codec")
+
+
+class CompressingWriter(object):
+    """A write-only file object which compresses into another file
+    object."""
+    def __init__(self, fp, codec, level=None, threads=None):
+        self.fp = fp
+        self.name = getattr(fp, "name", None)
+        self.compressor = compressor(codec, level, threads)
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.fp.write(compressed)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.fp.write(self.compressor.flush())
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DecompressingReader(object):
+    """A read-only file object over a stream of decompressed chunks.
+
+    We keep a read offset into the current chunk, and only drop what
+    has been read when we refill, so reading a line doesn't copy the
+    rest of the chunk.
+
+        >>> import StringIO
+        >>> text = "".join("line %d\\n" % i for i in range(100000))
+        >>> f = stream_reader(StringIO.StringIO(compress(text, "gzip")))
+        >>> lines = list(f)
+        >>> len(lines), "".join(lines) == text
+        (100000, True)
+    """
+    def __init__(self, fp, chunks):
+        self.fp = fp
+        self.name = getattr(fp, "name", None)
+        self.chunks = chunks
+        self.buffer = ''
+        self.position = 0  # Offset of the next unread byte in buffer
+        self.closed = False
+
+    def _fill(self):
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer = self.buffer[self.position:] + chunk
+                self.position = 0
+                return True
+        return False
+
+    def _take(self, end):
+        text = self.buffer[self.position:end]
+        self.position = end
+        return text
+
+    def read(self, size=-1):
+        if size < 0:
+            text = "".join([self.buffer[self.position:]] + list(self.chunks))
+            self.buffer = ''
+            self.position = 0
+            return text
+        while len(self.buffer) - self.position < size and self._fill():
+            pass
+        return self._take(min(self.position + size, len(self.buffer)))
+
+    def readline(self, size=-1):
+        newline = self.buffer.find('\n', self.position)
+        while newline < 0 and \
+                (size < 0 or len(self.buffer) - self.position < size):
+            searched = len(self.buffer) - self.position
+            if not self._fill():
+                break
+            newline = self.buffer.find('\n', searched)
+        end = len(self.buffer) if newline < 0 else newline + 1
+        if size >= 0:
+            end = min(end, self.position + size)
+        return self._take(end)
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.closed = True
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Uncompressed bytes per gzip member in ParallelGzipWriter
+BLOCK_SIZE = 1024 * 1024
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _thread_pool(threads):
+    """Helper: Return a thread pool shared by all the writers in this
+    process with the same number of threads, so opening many files
+    doesn't start many threads. Pools don't survive a fork, so each
+    process gets its own."""
+    key = (os.getpid(), threads)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = multiprocessing.pool.ThreadPool(threads)
+        return _pools[key]
+
+
+class ParallelGzipWriter(object):
+    """A write-only file object which gzips into another file object
+    using several threads, as pigz does. Data is cut into blocks of
+    `block_size` bytes, and each block is compressed as a separate
+    gzip member in a thread pool (zlib releases the GIL while it
+    works). Concatenated members are a valid gzip file, so the output
+    reads with gunzip, `gzip.open`, or `reader`, and each member is an
+    access point for `seekable` and for parallel reads in `streaming`.
+
+    The cost is a slightly worse compression ratio, as each block
+    starts with an empty dictionary. With 1MB blocks, this is well
+    under 1%.
+
+        >>> import StringIO
+        >>> raw = StringIO.StringIO()
+        >>> raw.close = lambda: None
+        >>> f = ParallelGzipWriter(raw, threads=4, block_size=8)
+        >>> f.write("hello\\nworld\\n")
+        >>> f.close()
+        >>> from xanalytics.gzipfs.seekable import build_index
+        >>> _ = raw.seek(0)
+        >>> len(build_index(raw)['members'])
+        2
+        >>> _ = raw.seek(0)
+        >>> list(reader(raw))
+        ['hello\\n', 'world\\n']
+    """
+    def __init__(self, fp, level=None, threads=None, block_size=None):
+        self.fp = fp
+        self.name = getattr(fp, "name", None)
+        self.level = level
+        self.threads = threads or multiprocessing.cpu_count()
+        self.block_size = block_size or BLOCK_SIZE
+        self.pool = _thread_pool(self.threads)
+        self.buffer = []
+        self.buffered = 0
+        # Compressed blocks, in order, which haven't been written yet.
+        self.pending = collections.deque()
+        self.closed = False
+
+    def _submit(self):
+        """Helper: Start compressing what we have buffered, and write
+        out finished blocks, keeping at most two per thread in
+        flight."""
+        if self.buffered:
+            block = "".join(self.buffer)
+            self.buffer = []
+            self.buffered = 0
+            self.pending.append(self.pool.apply_async(
+                compress, (block, 'gzip', self.level)))
+        while len(self.pending) > 2 * self.threads:
+            self.fp.write(self.pending.popleft().get())
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        while data:
+            take = self.block_size - self.buffered
+            self.buffer.append(data[:take])
+            self.buffered = self.buffered + len(self.buffer[-1])
+            data = data[take:]
+            if self.buffered >= self.block_size:
+                self._submit()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        """Write out everything written so far (as complete members)."""
+        self._submit()
+        while self.pending:
+            self.fp.write(self.pending.popleft().get())
+        self.fp.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _zstd_chunks(fp):
+    stream = zstandard.ZstdDecompressor().stream_reader(
+        fp, read_across_frames=True)
+    while True:
+        chunk = stream.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _lz4_chunks(fp):
+    decompressor = lz4.frame.LZ4FrameDecompressor()
+    while True:
+        data = fp.read(_CHUNK_SIZE)
+        if not data:
+            break
+        while data:
+            yield decompressor.decompress(data)
+            data = ''
+            if decompressor.eof:  # On to the next frame
+                data = decompressor.unused_data
+                decompressor = lz4.frame.LZ4FrameDecompressor()
+
+
+def _gzip_chunks(fp):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        data = fp.read(_CHUNK_SIZE)
+        if not data:
+            break
+        while data:
+            # Logs compress very well; we cap the output per call, so
+            # chunks stay a manageable size.
+            yield decompressor.decompress(data, _CHUNK_SIZE * 4)
+            data = decompressor.unconsumed_tail
+            if data:
+                continue
+            # Once a member ends, the rest of the input lands here.
+            data = decompressor.unused_data
+            if data:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def _raw_chunks(fp):
+    while True:
+        data = fp.read(_CHUNK_SIZE)
+        if not data:
+            break
+        yield data
+
+
+class _PrefixedFile(object):
+    """Helper: Put back bytes we've already read from a file object."""
+    def __init__(self, prefix, fp):
+        self.prefix = prefix
+        self.fp = fp
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fp.read(size)
+        if size < 0:
+            (text, self.prefix) = (self.prefix, '')
+            return text + self.fp.read()
+        (text, self.prefix) = (self.prefix[:size], self.prefix[size:])
+        if len(text) < size:
+            text = text + self.fp.read(size - len(text))
+        return text
+
+    def close(self):
+        self.fp.close()
+
+
+def stream_reader(fp):
+    """Wrap a file object which can't seek (e.g. an S3 key or HTTP
+    response) to decompress it as it is read, detecting the codec
+    from its first bytes. Unlike `reader`, nothing is ever seeked, and
+    uncompressed files are wrapped too.
+
+        >>> import StringIO
+        >>> data = compress("a\\nb", "gzip") + compress("c\\n", "gzip")
+        >>> list(stream_reader(StringIO.StringIO(data)))
+        ['a\\n', 'bc\\n']
+        >>> list(stream_reader(StringIO.StringIO("a\\nb")))
+        ['a\\n', 'b']
+    """
+    fp = _PrefixedFile(fp.read(4), fp)
+    codec = detect(fp.prefix)
+    if codec is not None:
+        check(codec)
+    chunks = {'gzip': _gzip_chunks,
+              'zstd': _zstd_chunks,
+              'lz4': _lz4_chunks,
+              None: _raw_chunks}[codec]
+    return DecompressingReader(fp, chunks(fp))
+
+
+def reader(fp, index=None):
+    """Wrap a (seekable) file object to decompress it, detecting the
+    codec from its first bytes. Files which don't look compressed are
+    returned as they are. `index` is a gzip index (see
+    `seekable.build_index`)."""
+    codec = detect(fp.read(4))
+    fp.seek(0)
+    if codec == 'gzip':
+        return SeekableGzipFile(fp, index)
+    if codec is not None:
+        check(codec)
+    if codec == 'zstd':
+        return DecompressingReader(fp, _zstd_chunks(fp))
+    elif codec == 'lz4':
+        return DecompressingReader(fp, _lz4_chunks(fp))
+    return fp
+
+
+def writer(fp, codec, level=None, threads=None, block_size=None):
+    """Wrap a file object to compress what is written to it with
+    `codec`. With no codec, the file object is returned as it is.
+
+    With more than one thread, gzip is written by a
+    `ParallelGzipWriter`, in members of `block_size` bytes. zstd has
+    its own threading."""
+    if codec is None:
+        return fp
+    if codec == 'gzip' and threads > 1:
+        return ParallelGzipWriter(fp, level, threads, block_size)
+    return CompressingWriter(fp, codec, level, threads)
@@ -0,0 +1,72 @@
+"""
+xanalytics.gzipfs.compressedfs
+==============================
+
+A wrapper which compresses files in any pyfs filesystem (OSFS,
+MemoryFS, TempFS, S3FS, ...). Files are written with the codec,
+level, and number of threads given, and the codec is detected from
+the first bytes of each file on reads.
+
+    >>> import fs.memoryfs
+    >>> memory = fs.memoryfs.MemoryFS()
+    >>> compressed = CompressedFS(memory, codec="gzip")
+    >>> _ = compressed.setcontents("a.txt", "hello\\n")
+    >>> compressed.getcontents("a.txt")
+    'hello\\n'
+    >>> codecs.detect(memory.getcontents("a.txt"))
+    'gzip'
+"""
+
+from fs.errors import UnsupportedError
+from fs.wrapfs import WrapFS
+
+from xanalytics.gzipfs import codecs
+
+
+class CompressedFS(WrapFS):
+    """
+    Compress the files in `wrapped_fs` with `codec` ('gzip', 'zstd',
+    'lz4', or None), at compression `level`, with `threads` threads
+    (where the codec supports it). gzip is compressed in parallel
+    `block_size` bytes at a time.
+    """
+    def __init__(self, wrapped_fs, codec='gzip', level=None, threads=None,
+                 block_size=None):
+        super(CompressedFS, self).__init__(wrapped_fs)
+        codecs.check(codec)
+        self.codec = codec
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
+
+    def __str__(self):
+        return "<CompressedFS: %s, %s>" % (self.wrapped_fs, self.codec)
+
+    __repr__ = __str__
+
+    def _adjust_mode(self, mode):
+        if '+' in mode:
+            raise UnsupportedError("open for reading and writing")
+        wmode = mode.replace('t', '')
+        if 'b' not in wmode:
+            wmode = wmode + 'b'
+        return (mode, wmode)
+
+    def _file_wrap(self, f, mode):
+        if 'r' in mode:
+            return codecs.reader(f)
+        return codecs.writer(f, self.codec, self.level, self.threads,
+                             self.block_size)
+
+    def getcontents(self, path, mode='rb', encoding=None, errors=None,
+                    newline=None):
+        f = self.open(path, mode)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,338 @@
+"""
+xanalytics.gzipfs.seekable
+==========================
+
+Random access to gzip files.
+
+`gzip.GzipFile` implements seeks by decompressing from the start of
+the file. Here, we keep access points: places in the compressed file
+where we can start decompressing, and the uncompressed offsets they
+correspond to. A seek then only decompresses from the nearest access
+point before the target.
+
+There are two kinds of access points:
+
+* Gzip member boundaries. Files written by `streaming.save_data`,
+  `bsonarchive`, or pigz-style writers are many concatenated members.
+  `build_index` finds them in one pass, and the index can be saved
+  (GZIPFS keeps it in an xattr, or a hidden file next to the data).
+* Checkpoints inside a member, every `span` bytes of output, made by
+  copying the decompressor as we read. Python 2's zlib can't restart
+  a stream from a saved window, so these can't be saved to disk, but
+  they make seeking back and forth within an open file cheap. Each
+  one holds about 40KB, so we only take them once the file has been
+  seeked (plain sequential reads don't need them), and keep at most
+  `MAX_CHECKPOINTS`: past that, we drop every other one and double
+  the span.
+
+Since only member boundaries are saved, a file which is one big
+member (like most tracking.log.gz files) can't be split into byte
+ranges to be read in parallel.
+
+    >>> import StringIO
+    >>> raw = StringIO.StringIO()
+    >>> for text in ["hello\\n", "world\\n"]:
+    ...     member = gzip.GzipFile(fileobj=raw, mode="w")
+    ...     _ = member.write(text)
+    ...     member.close()
+    >>> _ = raw.seek(0)
+    >>> index = build_index(raw)
+    >>> index['length'], len(index['members'])
+    (12, 2)
+    >>> f = SeekableGzipFile(raw, index)
+    >>> f.seek(6)
+    >>> f.read()
+    'world\\n'
+    >>> f.seek(0)
+    >>> list(f)
+    ['hello\\n', 'world\\n']
+"""
+
+import gzip
+import zlib
+
+GZIP_MAGIC = '\x1f\x8b'
+
+# Compressed bytes read at a time
+_CHUNK_SIZE = 64 * 1024
+
+# Uncompressed bytes between in-memory checkpoints, at first
+SPAN = 1024 * 1024
+# Most in-memory checkpoints per file
+MAX_CHECKPOINTS = 64
+
+
+class _Inflater(object):
+    """
+    Decompress a stream of concatenated gzip members, keeping track of
+    where each member starts.
+    """
+    def __init__(self, fp, offset=0, decompressor=None, leftover=''):
+        self.fp = fp
+        self.fp.seek(offset)
+        self.offset = offset  # Compressed offset of the end of our input
+        self.decompressor = decompressor
+        self.leftover = leftover
+        self.eof = False
+
+    def inflate(self, at_member=None):
+        """
+        Decompress the next chunk. Returns '' at the end of the file.
+        If given, `at_member(offset, output)` is called at the start of
+        each member, with its compressed offset and the length of the
+        output we returned before it.
+        """
+        output = []
+        while not output and not self.eof:
+            chunk = self.fp.read(_CHUNK_SIZE)
+            start = self.offset - len(self.leftover)
+            self.offset = self.offset + len(chunk)
+            raw = self.leftover + chunk
+            self.leftover = ''
+            if not chunk and self.decompressor is not None:
+                # zlib in Python 2 won't tell us if the stream ended. If
+                # it did, a trailing byte lands in unused_data.
+                self.decompressor.decompress('\x00')
+                if not self.decompressor.unused_data:
+                    raise IOError("Truncated gzip file")
+                self.decompressor = None
+            if not raw:
+                self.eof = True
+                break
+            while raw:
+                if self.decompressor is None:
+                    if len(raw) < len(GZIP_MAGIC) and chunk:
+                        self.leftover = raw
+                        break
+                    if not raw.startswith(GZIP_MAGIC):
+                        if start == 0:
+                            raise IOError("Not a gzipped file")
+                        # Trailing garbage (e.g. zero padding)
+                        self.eof = True
+                        break
+                    if at_member:
+                        at_member(start, sum(len(o) for o in output))
+                    self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                output.append(self.decompressor.decompress(raw))
+                unused = self.decompressor.unused_data
+                if unused:
+                    self.decompressor = None
+                start = start + len(raw) - len(unused)
+                raw = unused
+        return "".join(output)
+
+
+def build_index(fp):
+    """
+    Find the members of a gzip file. Returns a dictionary with the
+    uncompressed `length` of the file, and a list of `members`, as
+    [compressed offset, uncompressed offset] pairs.
+    """
+    members = []
+    length = [0]
+
+    def at_member(offset, output):
+        members.append([offset, length[0] + output])
+
+    inflater = _Inflater(fp)
+    while True:
+        text = inflater.inflate(at_member)
+        if not text:
+            break
+        length[0] = length[0] + len(text)
+    return {'length': length[0], 'members': members}
+
+
+class SeekableGzipFile(object):
+    """
+    A read-only file object for a gzip file, which supports fast seeks
+    using an index from `build_index` (if given), and checkpoints taken
+    every `span` bytes as we read, once we've been seeked.
+
+        >>> import StringIO
+        >>> text = "".join("line %d\\n" % i for i in range(200000))
+        >>> raw = StringIO.StringIO()
+        >>> member = gzip.GzipFile(fileobj=raw, mode="w")
+        >>> _ = member.write(text)
+        >>> member.close()
+        >>> f = SeekableGzipFile(raw, span=1000)
+        >>> f.read() == text, len(f.points)
+        (True, 1)
+        >>> f.seek(10)
+        >>> f.read() == text[10:], len(f.points) <= MAX_CHECKPOINTS + 1
+        (True, True)
+        >>> f.seek(len(text) / 2)
+        >>> f.read(7) == text[len(text) / 2:][:7]
+        True
+    """
+    def __init__(self, fp, index=None, span=SPAN):
+        self.fp = fp
+        self.name = getattr(fp, "name", None)
+        self.span = span
+        # Access points, as (uncompressed offset, compressed offset,
+        # decompressor, leftover)
+        self.points = [(0, 0, None, '')]
+        if index:
+            self.points = [(uoffset, coffset, None, '')
+                           for (coffset, uoffset) in index['members']] or \
+                self.points
+        self.members = set(point[0] for point in self.points)
+        self.length = index['length'] if index else None
+        self.checkpoints = 0  # Points with a saved decompressor
+        self.seeked = False
+        self.closed = False
+        self._restart(self.points[0])
+
+    def _restart(self, point):
+        (uoffset, coffset, decompressor, leftover) = point
+        if decompressor is not None:
+            decompressor = decompressor.copy()
+        self.inflater = _Inflater(self.fp, coffset, decompressor, leftover)
+        self.buffer = ''
+        self.buffer_offset = uoffset  # Uncompressed offset of buffer[0]
+        self.position = uoffset
+        self.next_checkpoint = uoffset + self.span
+
+    def _fill(self):
+        """
+        Helper: Decompress more into the buffer. Returns False at the
+        end of the file.
+        """
+        end = self.buffer_offset + len(self.buffer)
+
+        def at_member(offset, output):
+            if end + output not in self.members:
+                self.members.add(end + output)
+                self.points.append((end + output, offset, None, ''))
+
+        text = self.inflater.inflate(at_member)
+        if not text:
+            if self.length is None:
+                self.length = end
+            return False
+        skip = self.position - self.buffer_offset
+        self.buffer = self.buffer[skip:] + text
+        self.buffer_offset = self.position
+        end = self.buffer_offset + len(self.buffer)
+        if end >= self.next_checkpoint and self.seeked and \
+           self.inflater.decompressor is not None:
+            self.points.append((end,
+                                self.inflater.offset,
+                                self.inflater.decompressor.copy(),
+                                self.inflater.leftover))
+            self.checkpoints = self.checkpoints + 1
+            if self.checkpoints > MAX_CHECKPOINTS:
+                self._thin()
+            self.next_checkpoint = end + self.span
+        return True
+
+    def _thin(self):
+        """
+        Helper: Drop every other checkpoint, and double the span, so
+        they stay spread over the file.
+        """
+        kept = []
+        checkpoints = 0
+        for point in sorted(self.points, key=lambda p: (p[0], p[1])):
+            if point[2] is not None:
+                checkpoints = checkpoints + 1
+                if checkpoints % 2:
+                    continue
+            kept.append(point)
+        self.points = kept
+        self.checkpoints = checkpoints / 2
+        self.span = self.span * 2
+
+    def seek(self, offset, whence=0):
+        self.seeked = True
+        if whence == 1:
+            offset = self.position + offset
+        elif whence == 2:
+            if self.length is None:
+                while self._fill():
+                    pass
+            offset = self.length + offset
+        if offset < 0:
+            raise IOError("Negative seek in gzip file")
+        end = self.buffer_offset + len(self.buffer)
+        if self.buffer_offset <= offset <= end:
+            self.position = offset
+            return
+        # Restart from the last access point before the target, unless
+        # we're already past it and before the target.
+        point = max((p for p in self.points if p[0] <= offset),
+                    key=lambda p: (p[0], p[1]))
+        if not (point[0] <= self.buffer_offset and end < offset):
+            self._restart(point)
+        while self.buffer_offset + len(self.buffer) < offset:
+            self.position = self.buffer_offset + len(self.buffer)
+            if not self._fill():
+                break
+        self.position = min(offset, self.buffer_offset + len(self.buffer))
+
+    def tell(self):
+        return self.position
+
+    def _take(self, size):
+        """
+        Helper: Return up to `size` (or, if negative, all) buffered
+        bytes from the current position.
+        """
+        start = self.position - self.buffer_offset
+        text = self.buffer[start:] if size < 0 else \
+            self.buffer[start:start + size]
+        self.position = self.position + len(text)
+        return text
+
+    def read(self, size=-1):
+        pieces = [self._take(size)]
+        read = len(pieces[0])
+        while (size < 0 or read < size) and self._fill():
+            pieces.append(self._take(size - read if size >= 0 else -1))
+            read = read + len(pieces[-1])
+        return "".join(pieces)
+
+    def readline(self, size=-1):
+        pieces = []
+        read = 0
+        while True:
+            start = self.position - self.buffer_offset
+            newline = self.buffer.find('\n', start)
+            if newline >= 0:
+                length = newline + 1 - start
+                if size >= 0:
+                    length = min(length, size - read)
+                pieces.append(self._take(length))
+                break
+            pieces.append(self._take(size - read if size >= 0 else -1))
+            read = read + len(pieces[-1])
+            if (size >= 0 and read >= size) or not self._fill():
+                break
+        return "".join(pieces)
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.closed = True
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
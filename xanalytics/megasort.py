@@ -7,8 +7,9 @@ This is a system designed to sort pretty big files. It will:
   file
 
 This will not run out of file pointers, memory, or have similar issues
-often associated with pretty big data. However, it's not parallel, or
-distributed, so it will not scale to very big files.
+often associated with pretty big data. It can use several cores on
+one machine (`processes`), but it's not distributed, so it will not
+scale to very big files.
 
 It's not a bad starting point for a cluster sort like that. The steps
 would be:
@@ -18,22 +19,30 @@ would be:
   but merge into several files, with fixed break points
 * Have machines do a final merge on those files
 
-It would make sense to do this just to use multiple cores on one
-machine. A naive version of this -- where I queued in objects into
-individual forks -- was slower than not doing this at all. The queuing
-took longer than the first-pass sorting. A non-naive, blocked version
-ought to give an 8x performance boost, however.
+We do this to use multiple cores on one machine. A naive version of
+this -- where I queued in objects into individual forks -- was slower
+than not doing this at all. The queuing took longer than the
+first-pass sorting. The current version is blocked: each worker gets
+a whole block to sort, and writes its own run file, so only the raw
+input goes through the queue.
 
-Progress indication would be kind of nice too.
+Progress is reported through a callback (see `SortProgress`). By
+default, we print a progress line to stderr.
 '''
 
+import collections
+import datetime
+import fs.osfs
 import fs.tempfs
 import heapq
 import itertools
+import json
 import md5
+import struct
 import sys
 import time
 import uuid
+import zlib
 
 import xanalytics.multiprocess
 
@@ -87,6 +96,382 @@ def file_generator(filesystem):
         yield (filename, filesystem.open(filename, "w"))
 
 
+# Run files are binary. They start with a one-byte flag saying
+# whether they are compressed, followed by blocks. Each block is a
+# 4-byte length and a (possibly zlib-compressed) payload. Payloads
+# hold records: 4-byte key length, 4-byte item length, key, item.
+# Keys and items are UTF-8. Keeping the key lets merge passes compare
+# keys without re-parsing items, and lengths mean items can hold any
+# characters (including tabs and newlines).
+#
+# A zero length ends the blocks. It is followed by an index, with the
+# offset and first key of each block (8-byte offset, 4-byte key
+# length, key), and then the 8-byte offset of the index. This lets a
+# merge of a key range seek straight to the first block it needs.
+_RUN_BLOCK_SIZE = 1024 * 1024
+_RECORD_HEADER = struct.Struct('<II')
+_BLOCK_HEADER = struct.Struct('<I')
+_INDEX_ENTRY = struct.Struct('<QI')
+_RUN_TRAILER = struct.Struct('<Q')
+
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+def _write_run(filesystem, pairs, compress=False):
+    '''
+    Write sorted (key, item) pairs to a new temporary file. Returns
+    the filename.
+    '''
+    filename = filename_generator().next()
+    filepointer = filesystem.open(filename, "wb")
+    filepointer.write('Z' if compress else 'R')
+    offset = [1]
+    index = []  # (offset, first key) of each block
+
+    def write_block(records):
+        index.append((offset[0], records[1]))
+        payload = "".join(records)
+        if compress:
+            payload = zlib.compress(payload, 1)
+        filepointer.write(_BLOCK_HEADER.pack(len(payload)))
+        filepointer.write(payload)
+        offset[0] = offset[0] + _BLOCK_HEADER.size + len(payload)
+
+    records = []
+    size = 0
+    for (key, item) in pairs:
+        key = _utf8(key)
+        item = _utf8(item)
+        records.append(_RECORD_HEADER.pack(len(key), len(item)))
+        records.append(key)
+        records.append(item)
+        size = size + _RECORD_HEADER.size + len(key) + len(item)
+        if size > _RUN_BLOCK_SIZE:
+            write_block(records)
+            records = []
+            size = 0
+    if records:
+        write_block(records)
+    filepointer.write(_BLOCK_HEADER.pack(0))
+    for (block_offset, key) in index:
+        filepointer.write(_INDEX_ENTRY.pack(block_offset, len(key)))
+        filepointer.write(key)
+    filepointer.write(_RUN_TRAILER.pack(offset[0] + _BLOCK_HEADER.size))
+    filepointer.close()
+    return filename
+
+
+def _seek_run(filepointer, low):
+    '''
+    Helper: Seek a run file to the first block which might hold keys
+    of at least `low`, using the index at the end of the file.
+    '''
+    filepointer.seek(-_RUN_TRAILER.size, 2)
+    (index_offset,) = _RUN_TRAILER.unpack(
+        filepointer.read(_RUN_TRAILER.size))
+    filepointer.seek(index_offset)
+    index = filepointer.read()[:-_RUN_TRAILER.size]
+    start = 1
+    position = 0
+    while position < len(index):
+        (block_offset, key_length) = _INDEX_ENTRY.unpack_from(index,
+                                                              position)
+        position = position + _INDEX_ENTRY.size
+        key = index[position:position + key_length]
+        position = position + key_length
+        # Keys equal to `low` may start in the block before one
+        # which begins with `low`.
+        if key >= low:
+            break
+        start = block_offset
+    filepointer.seek(start)
+
+
+def _read_run(filesystem, filename, low=None, high=None):
+    '''
+    Yield the (key, item) pairs in a run file, as UTF-8 byte
+    strings. If `low` or `high` are given, only keys in [low, high)
+    are returned. We skip straight to the blocks holding `low`.
+
+    >>> import fs.memoryfs
+    >>> memory = fs.memoryfs.MemoryFS()
+    >>> pairs = [("%05d" % i, "item %d" % i + " " * 100)
+    ...          for i in range(50000)]
+    >>> run = _write_run(memory, pairs, compress=True)
+    >>> list(_read_run(memory, run)) == pairs
+    True
+    >>> [k for (k, item) in _read_run(memory, run, "30000", "30002")]
+    ['30000', '30001']
+    >>> len(list(_read_run(memory, run, "4", None)))
+    10000
+    '''
+    low = _utf8(low)
+    high = _utf8(high)
+    filepointer = filesystem.open(filename, "rb")
+    compressed = filepointer.read(1) == 'Z'
+    if low is not None:
+        _seek_run(filepointer, low)
+    while True:
+        header = filepointer.read(_BLOCK_HEADER.size)
+        if len(header) < _BLOCK_HEADER.size:
+            break
+        length = _BLOCK_HEADER.unpack(header)[0]
+        if not length:
+            break
+        payload = filepointer.read(length)
+        if compressed:
+            payload = zlib.decompress(payload)
+        position = 0
+        while position < len(payload):
+            (key_length, item_length) = _RECORD_HEADER.unpack_from(payload,
+                                                                   position)
+            position = position + _RECORD_HEADER.size
+            key = payload[position:position + key_length]
+            position = position + key_length
+            item = payload[position:position + item_length]
+            position = position + item_length
+            if low is not None and key < low:
+                continue
+            if high is not None and key >= high:
+                filepointer.close()
+                return
+            yield (key, item)
+    filepointer.close()
+
+
+def _sort_block(block, key, cmp):
+    '''
+    Sort a block of items in memory. Returns sorted (key, item) pairs.
+    '''
+    pairs = [(_utf8(key(item)), item.strip()) for item in block]
+    pairs.sort(key=lambda x: x[0], cmp=cmp)
+    return pairs
+
+
+# Rough bytes of bookkeeping per item while sorting a block, on top of
+# the item itself: the key, the (key, item) tuple, and list slots.
+_ITEM_OVERHEAD = 150
+
+
+def measured_size(item):
+    '''
+    Estimate how much memory sorting an item takes, in bytes.
+    '''
+    return sys.getsizeof(item) + _ITEM_OVERHEAD
+
+
+def parse_size(size):
+    '''
+    Turn a human-friendly memory size into bytes.
+
+    >>> parse_size("8G")
+    8589934592
+    >>> parse_size("512 MB")
+    536870912
+    >>> parse_size(1000)
+    1000
+    '''
+    if not isinstance(size, basestring):
+        return int(size)
+    size = size.strip().upper().rstrip("B").strip()
+    for (suffix, multiplier) in [("K", 2 ** 10), ("M", 2 ** 20),
+                                 ("G", 2 ** 30), ("T", 2 ** 40)]:
+        if size.endswith(suffix):
+            return int(float(size[:-1]) * multiplier)
+    return int(size)
+
+
+def _block_budget(memory, processes, parallel):
+    '''
+    Split a memory budget between the blocks which may be in memory
+    at once. With workers, a block is being built here, two per
+    worker are queued, and one per worker is being sorted.
+    '''
+    if parallel:
+        return parse_size(memory) // (3 * processes + 1)
+    return parse_size(memory)
+
+
+def _human(number):
+    '''
+    Format a number compactly, for progress output.
+
+    >>> _human(1234567)
+    '1.2M'
+    >>> _human(12)
+    '12'
+    '''
+    for (suffix, size) in [("T", 1e12), ("G", 1e9), ("M", 1e6), ("k", 1e3)]:
+        if number >= size:
+            return "{0:.1f}{1}".format(number / size, suffix)
+    return str(int(number))
+
+
+def print_progress(stats):
+    '''
+    The default progress callback. Keeps a one-line status on stderr,
+    in the style of tqdm.
+    '''
+    if stats['eta'] is None:
+        eta = "?"
+    else:
+        eta = str(datetime.timedelta(seconds=int(stats['eta'])))
+    line = "{phase} {level}: {items} items, {ips} items/s, {bps}B/s, " \
+        "{runs} runs, {temp}B temp, ETA {eta}".format(
+            phase=stats['phase'],
+            level=stats['level'],
+            items=_human(stats['items']),
+            ips=_human(stats['items_per_second']),
+            bps=_human(stats['bytes_per_second']),
+            runs=stats['runs'],
+            temp=_human(stats['temp_bytes']),
+            eta=eta)
+    end = "\n" if stats['phase'] == "done" else ""
+    sys.stderr.write("\r" + line.ljust(100) + end)
+    sys.stderr.flush()
+
+
+class SortProgress(object):
+    '''
+    Keep track of how far along a sort is, and report it to a
+    callback. The callback gets a dictionary with:
+
+    * phase: "sort" (the first pass), "merge", "output" or "done"
+    * level: merge pass number (0 on the first pass)
+    * items, bytes: processed so far in this phase
+    * items_per_second, bytes_per_second: over the whole sort
+    * runs: number of temporary run files
+    * temp_bytes: space used by run files
+    * elapsed, eta: in seconds. eta is None until we can tell
+      (after the first pass, unless we're given `total_items`).
+
+    The callback is called after each run or merge group, and every
+    `interval` items of output.
+    '''
+    def __init__(self,
+                 callback=print_progress,
+                 filesystem=None,
+                 file_limit=1000,
+                 total_items=None,
+                 interval=100000):
+        self.callback = callback
+        self.filesystem = filesystem
+        self.file_limit = file_limit
+        self.total_items = total_items
+        self.interval = interval
+        self.start_time = time.time()
+        self.phase = "sort"
+        self.level = 0
+        self.items = 0
+        self.bytes = 0
+        self.work_items = 0  # Items processed, over all phases
+        self.work_bytes = 0
+        self.runs = {}  # filename -> (items, bytes, size on disk)
+
+    def add_run(self, filename, items, nbytes):
+        size = 0
+        if self.filesystem is not None:
+            size = self.filesystem.getsize(filename)
+        self.runs[filename] = (items, nbytes, size)
+
+    def remove_run(self, filename):
+        self.runs.pop(filename, None)
+
+    def run_stats(self, filenames):
+        '''
+        Total (items, bytes) in a set of runs.
+        '''
+        stats = [self.runs.get(f, (0, 0, 0)) for f in filenames]
+        return (sum(s[0] for s in stats), sum(s[1] for s in stats))
+
+    def start_phase(self, phase, level=0):
+        if self.phase == "sort" and phase != "sort":
+            self.total_items = self.items
+        self.phase = phase
+        self.level = level
+        self.items = 0
+        self.bytes = 0
+
+    def advance(self, items, nbytes, report=True):
+        self.items = self.items + items
+        self.bytes = self.bytes + nbytes
+        self.work_items = self.work_items + items
+        self.work_bytes = self.work_bytes + nbytes
+        if report:
+            self.report()
+
+    def _remaining_passes(self):
+        '''
+        How many more times we'll go through all the items (counting
+        the current pass).
+        '''
+        runs = len(self.runs)
+        passes = 1
+        if self.phase == "sort":
+            runs = max(runs, 1) * self.total_items / max(self.items, 1)
+            passes = passes + 1
+        while runs > self.file_limit:
+            runs = -(-runs // self.file_limit)
+            passes = passes + 1
+        if self.phase == "output":
+            passes = 1
+        return passes
+
+    def stats(self):
+        elapsed = time.time() - self.start_time
+        rate = self.work_items / elapsed if elapsed > 0 else 0
+        eta = None
+        if self.total_items and rate > 0 and self.phase != "done":
+            remaining = self._remaining_passes() * self.total_items - \
+                self.items
+            eta = max(remaining, 0) / rate
+        return {'phase': self.phase,
+                'level': self.level,
+                'items': self.items,
+                'bytes': self.bytes,
+                'items_per_second': rate,
+                'bytes_per_second': self.work_bytes / elapsed
+                if elapsed > 0 else 0,
+                'runs': len(self.runs),
+                'temp_bytes': sum(r[2] for r in self.runs.values()),
+                'elapsed': elapsed,
+                'eta': eta}
+
+    def report(self):
+        if self.callback:
+            self.callback(self.stats())
+
+
+def _blocks(data_source, ramsize, ram_requirements):
+    '''
+    Break the input into lists of items, each of which fits in
+    `ramsize`.
+    '''
+    block = []
+    size = 0
+    for item in data_source:
+        block.append(item)
+        size = size + ram_requirements(item)
+        if size > ramsize:
+            yield block
+            block = []
+            size = 0
+    if block:
+        yield block
+
+
+def _parallel(filesystem, processes):
+    '''
+    Should we use worker processes? Workers write their own files, so
+    they need a filesystem which they share with us (not a MemoryFS).
+    '''
+    return processes and processes > 1 and filesystem.hassyspath("/")
+
+
 def quick_sort_sets(data_source,
                     filesystem=fs.tempfs.TempFS(),
                     key=None,
@@ -94,39 +479,140 @@ def quick_sort_sets(data_source,
                     file_limit=1000,
                     ramsize=1000,
                     breakpoints=[],
-                    ram_requirements=lambda x: 1):
+                    ram_requirements=lambda x: 1,
+                    processes=None,
+                    memory=None,
+                    compress=False,
+                    progress=None):
     """
     On a first pass, we break up the input into many small, sorted
-    files. This is a helper which makes that first pass.
-    """
-    items = []
-    total_size = [0]  # Hack for Python 2.x scoping rules. See:
-    # http://stackoverflow.com/questions/4851463/python-closure-write-to-variable-in-parent-scope
+    files. This is a helper which makes that first pass. Yields the
+    filenames.
+
+    `progress` is a SortProgress, or a callback for one (see
+    SortProgress).
 
+    With `processes`, blocks of input are sorted and written in that
+    many worker processes.
+
+    If `memory` is given (bytes, or a string like "8G"), blocks are cut
+    by the measured size of the items, to keep the whole first pass
+    within that budget. Otherwise, `ramsize` is in whatever units
+    `ram_requirements` returns (by default, items).
+    """
     if not key:
         def key(x):
-            x
+            return x
+
+    def sort_and_write(blocks):
+        for block in blocks:
+            yield _write_run(filesystem,
+                             _sort_block(block, key, cmp),
+                             compress)
+
+    if memory:
+        ramsize = _block_budget(memory,
+                                processes,
+                                _parallel(filesystem, processes))
+        ram_requirements = measured_size
+    if progress is not None and not isinstance(progress, SortProgress):
+        progress = SortProgress(progress, filesystem, file_limit)
+    blocks = _blocks(data_source, ramsize, ram_requirements)
+    # Runs come back in the same order as blocks go out, so we queue
+    # up the block sizes to match them with their runs.
+    block_sizes = collections.deque()
+
+    def measure(blocks):
+        for block in blocks:
+            block_sizes.append((len(block), sum(len(item) for item in block)))
+            yield block
+
+    if _parallel(filesystem, processes):
+        # One block per chunk. Blocks are big, so the queueing
+        # overhead is small compared to the sort.
+        pipeline = xanalytics.multiprocess.ParallelPipeline(
+            sort_and_write,
+            processes=processes,
+            chunk_size=1)
+        filenames = pipeline.map(measure(blocks))
+    else:
+        filenames = sort_and_write(measure(blocks))
+
+    for filename in filenames:
+        (items, nbytes) = block_sizes.popleft()
+        if progress is not None:
+            progress.add_run(filename, items, nbytes)
+            progress.advance(items, nbytes)
+        yield filename
+
+
+class _Manifest(object):
+    '''
+    A checkpoint of a sort in progress. This records which runs exist
+    (with their item and byte counts), how many input items went into
+    them, and whether the first pass and the final partitioning are
+    done.
+
+    If the sort is `persistent`, the manifest is saved to the
+    filesystem each time it changes, so a restarted sort can pick up
+    where it left off. Otherwise, it is only kept in memory.
+    '''
+    FILENAME = "megasort-manifest.json"
+
+    def __init__(self, filesystem, persistent=False):
+        self.filesystem = filesystem
+        self.persistent = persistent
+        self.state = {'consumed': 0,
+                      'first_pass_done': False,
+                      'level': 0,
+                      'partitioned': False,
+                      'runs': []}
+        if persistent and filesystem.exists(self.FILENAME):
+            self.state = json.loads(filesystem.getcontents(self.FILENAME))
+            self.remove_orphans()
+
+    def __getitem__(self, key):
+        return self.state[key]
+
+    def __setitem__(self, key, value):
+        self.state[key] = value
+
+    def files(self):
+        return [run[0] for run in self.state['runs']]
+
+    def remove_orphans(self):
+        '''
+        Remove temporary files which aren't in the manifest. These are
+        runs which were being written, or merge inputs which were
+        being deleted, when we crashed.
+        '''
+        known = set(self.files())
+        for filename in self.filesystem.listdir(files_only=True):
+            if filename.startswith("tmp-") and filename not in known:
+                self.filesystem.remove(filename)
 
-    fg = file_generator(filesystem)
+    def save(self):
+        '''
+        Write the manifest. We write a new file and rename it over the
+        old one, so we never leave half a manifest.
+        '''
+        if not self.persistent:
+            return
+        temp = self.FILENAME + ".tmp"
+        self.filesystem.setcontents(temp, json.dumps(self.state))
+        self.filesystem.rename(temp, self.FILENAME)
 
-    def init():
-        del items[:]
-        total_size[0] = 0
+    def finish(self):
+        if self.persistent and self.filesystem.exists(self.FILENAME):
+            self.filesystem.remove(self.FILENAME)
 
-    def finalize():
-        items.sort(key=lambda x: x[0], cmp=cmp)
-        (filename, filepointer) = fg.next()
-        filepointer.writelines(unicode("\t".join(line)+'\n') for line in items)
-        filepointer.close()
-        return filename
 
-    for item in data_source:
-        items.append((key(item), item.strip()))
-        total_size[0] += ram_requirements(item)
-        if total_size[0] > ramsize:
-            yield finalize()
-            init()
-    yield finalize()
+def _merge_runs(filesystem, filenames, low=None, high=None):
+    '''
+    Merge sorted run files into a stream of (key, item) pairs.
+    '''
+    return heapq.merge(*[_read_run(filesystem, filename, low, high)
+                         for filename in filenames])
 
 
 def megasort(data_source,
@@ -136,7 +622,13 @@ def megasort(data_source,
              file_limit=1000,
              ramsize=1000,
              breakpoints=[],
-             ram_requirements=lambda x: 1):
+             ram_requirements=lambda x: 1,
+             processes=None,
+             memory=None,
+             compress=False,
+             progress=print_progress,
+             total_items=None,
+             workdir=None):
     """
     This allows us to sort big-ish data. We need a key to sort on.
 
@@ -147,73 +639,182 @@ def megasort(data_source,
 
     Open up `file_limit` files. Merge them. Delete the originals.
 
-    Iterate.
+    Iterate, until there are at most `file_limit` files. Merge those
+    as we return them.
 
-    TODO: We write out bad blocks to an additional file, `err`
-    """
-    files = []
+    With `processes`, the first-pass sorts, and the merges within a
+    pass, run in parallel in worker processes. If `breakpoints` (a
+    list of keys) are given too, the final merge is split into key
+    ranges between the breakpoints, and the ranges are merged in
+    parallel.
 
-    start_time = time.time()
+    The merge compares keys as (UTF-8) byte strings, so `cmp` should
+    agree with string ordering.
 
-    # First, we make a bunch of small, internally-sorted files. Each
-    # line has a key, tab, then line.
-    #
-    # To make parallel:
-    # Change data_source to xanalytics.multiprocess.split(data_source, 16)
-    file_iter = quick_sort_sets(data_source,
-                                filesystem,
-                                key,
-                                cmp,
-                                file_limit,
-                                ramsize,
-                                breakpoints,
-                                ram_requirements)
+    `memory` is a memory budget for the first pass, in bytes (or a
+    string like "8G"). If it's given, `ramsize` is ignored. If
+    `compress`, temporary files are compressed (a good idea if disk is
+    slower than the CPU). Items come out as unicode.
 
-    remaining_files = itertools.chain(file_iter, files)
+    `progress` is a callback for progress reports (see SortProgress),
+    or None for no reports. If we know `total_items` up front, we can
+    give an ETA for the first pass too.
 
-    fg = file_generator(filesystem)
+    If `workdir` (a pyfs, or a directory) is given, temporary files go
+    there instead of `filesystem`, along with a manifest of finished
+    work. If the sort dies, calling megasort again with the same
+    input and parameters picks up after the last finished run or
+    merge. Input items which already went into runs are skipped (so
+    the input needs to come in the same order). Output always starts
+    from the beginning.
+
+    TODO: We write out bad blocks to an additional file, `err`
+    """
+    if isinstance(workdir, basestring):
+        workdir = fs.osfs.OSFS(workdir, create=True)
+    if workdir is not None:
+        filesystem = workdir
+    parallel = _parallel(filesystem, processes)
+    tracker = SortProgress(progress, filesystem, file_limit, total_items)
+    manifest = _Manifest(filesystem, persistent=workdir is not None)
+    for (filename, items, nbytes) in manifest['runs']:
+        tracker.add_run(filename, items, nbytes)
+
+    # First, we make a bunch of small, internally-sorted files, each
+    # holding (key, item) records.
+    files = manifest.files()
+    if not manifest['first_pass_done']:
+        tracker.items = manifest['consumed']
+        data_source = itertools.islice(data_source, manifest['consumed'], None)
+        for filename in quick_sort_sets(data_source,
+                                        filesystem,
+                                        key,
+                                        cmp,
+                                        file_limit,
+                                        ramsize,
+                                        breakpoints,
+                                        ram_requirements,
+                                        processes,
+                                        memory,
+                                        compress,
+                                        tracker):
+            (items, nbytes, size) = tracker.runs[filename]
+            manifest['runs'].append([filename, items, nbytes])
+            manifest['consumed'] = manifest['consumed'] + items
+            manifest.save()
+            files.append(filename)
+        manifest['first_pass_done'] = True
+        manifest.save()
+
+    def merge_groups(groups):
+        for group in groups:
+            yield _write_run(filesystem,
+                             _merge_runs(filesystem, group),
+                             compress)
+
+    # Now, we merge these files, `file_limit` at a time, until there
+    # are few enough to merge in one go. After each group, we record
+    # the new run in the manifest before removing the old ones.
+    level = manifest['level']
+    while len(files) > file_limit and not manifest['partitioned']:
+        level = level + 1
+        manifest['level'] = level
+        tracker.start_phase("merge", level)
+        groups = [files[i:i + file_limit]
+                  for i in range(0, len(files), file_limit)]
+        if parallel:
+            pipeline = xanalytics.multiprocess.ParallelPipeline(
+                merge_groups,
+                processes=processes,
+                chunk_size=1)
+            merged = pipeline.map(groups)
+        else:
+            merged = merge_groups(groups)
+        files = []
+        for (group, filename) in itertools.izip(groups, merged):
+            (items, nbytes) = tracker.run_stats(group)
+            manifest['runs'] = [run for run in manifest['runs']
+                                if run[0] not in group]
+            manifest['runs'].append([filename, items, nbytes])
+            manifest.save()
+            for f in group:
+                filesystem.remove(f)
+                tracker.remove_run(f)
+            tracker.add_run(filename, items, nbytes)
+            tracker.advance(items, nbytes)
+            files.append(filename)
+        # If we resumed partway through a pass, some groups are runs
+        # from the pass after. That's fine; any sorted runs can be
+        # merged together.
+
+    tracker.start_phase("output", level + 1)
+
+    def output(items):
+        count = 0
+        nbytes = 0
+        for item in items:
+            count = count + 1
+            nbytes = nbytes + len(item)
+            if count == tracker.interval:
+                tracker.advance(count, nbytes)
+                count = 0
+                nbytes = 0
+            yield item.decode('utf-8')
+        tracker.advance(count, nbytes)
+
+    if manifest['partitioned']:
+        # We crashed while returning the output. The partitions are
+        # still there.
+        for item in output(item
+                           for partition in files
+                           for (k, item) in _read_run(filesystem, partition)):
+            yield item
+        for partition in files:
+            filesystem.remove(partition)
+    elif parallel and breakpoints:
+        # Split the final merge into key ranges. Each range goes to
+        # its own file, and we return the files in order.
+        bounds = [None] + sorted(breakpoints) + [None]
+        ranges = zip(bounds[:-1], bounds[1:])
+
+        def merge_ranges(ranges):
+            for (low, high) in ranges:
+                yield _write_run(filesystem,
+                                 _merge_runs(filesystem, files, low, high),
+                                 compress)
+
+        pipeline = xanalytics.multiprocess.ParallelPipeline(
+            merge_ranges,
+            processes=processes,
+            chunk_size=1)
+        partitions = list(pipeline.map(ranges))
+        manifest['runs'] = [[partition, 0, 0] for partition in partitions]
+        manifest['partitioned'] = True
+        manifest.save()
+        for f in files:
+            filesystem.remove(f)
+            tracker.remove_run(f)
+        for partition in partitions:
+            tracker.add_run(partition, 0, 0)
+        tracker.report()
+        for item in output(item
+                           for partition in partitions
+                           for (k, item) in _read_run(filesystem, partition)):
+            yield item
+        for partition in partitions:
+            filesystem.remove(partition)
+            tracker.remove_run(partition)
+    else:
+        for item in output(item for (k, item)
+                           in _merge_runs(filesystem, files)):
+            yield item
+        for f in files:
+            filesystem.remove(f)
+            tracker.remove_run(f)
+    manifest.finish()
+    tracker.phase = "done"
+    tracker.report()
 
-    # Now, we merge these files.
-    while True:
-        # We grab the first bunch of files
-        working_files = list(itertools.islice(remaining_files, file_limit))
-        if len(working_files) < 2:
-            break
-        # We grab pointers to data from those files
-        working_filepointers = ((x.split('\t') for x in filesystem.open(fn))
-                                for fn in working_files)
-        # We merge them
-        output = heapq.merge(*working_filepointers)
-        # We make a new file, and dump the merged results there
-        (filename, filepointer) = fg.next()
-        filepointer.writelines(unicode("\t".join(line)) for line in output)
-        filepointer.close()
-        # And we update out file list with the new file, removing the old ones
-        files.append(filename)
-        for file in working_files:
-            filesystem.remove(file)
-        print >> sys.stderr, "Sort pass", len(files), time.time()-start_time
-
-    # We might end up with the final file in working_files or not,
-    # depending on how things line up with the islice above. If we run
-    # out of items in working_files, then hit the end of the
-    # generator, and then add to files, the generator will be done,
-    # and we'll end up with the filename only in files. If we run out
-    # of files but don't hit the end of the generator, we'll end up
-    # with this in working files and files. It stays in files either
-    # way (for now) since that's an array.
-    print >> sys.stderr, "Working:", working_files
-    print >> sys.stderr, "Files:", files
-    print >> sys.stderr, "Combined:", working_files+files
-    print >> sys.stderr, filesystem.listdir()
-    out = filesystem.open(files[-1])
-    for line in out:
-        try:
-            line = line.split('\t')[1]
-        except:
-            print >> sys.stderr, "[", line, "]"
-            raise
-        yield line.strip()
 
 if __name__ == '__main__':
     '''
@@ -251,7 +852,6 @@ if __name__ == '__main__':
         # RAM_SIZE = 1000
 
     import fs.memoryfs
-    filesystem = fs.memoryfs.MemoryFS()
 
     def data_generator():
         '''
@@ -260,25 +860,32 @@ if __name__ == '__main__':
         for i in range(int(ITEM_COUNT)):
             yield unicode(uuid.uuid4())
 
-    data = data_generator()
-    new_data = megasort(data,
-                        filesystem,
-                        file_limit=FILE_LIMIT,
-                        ramsize=RAM_SIZE,
-                        # key=lambda x:"".join(reversed(x)),
-                        breakpoints="1234567890abcdef")
-
-    old_item = None
-    c = []
-    d = []
-    for item in new_data:
-        if old_item:
-            c.append(item > old_item)
-            d.append(item == old_item)
-        old_item = item
-    if len(c)+1 != ITEM_COUNT:
-        raise "We did not have the correct number of items"
-    if not reduce((lambda x, y: x and y), c):
-        raise "Items were not in the correct order"
-    if reduce((lambda x, y: x or y), d):
-        raise "Possible duplicate item"
+    # We run once in-memory on one core, and once with worker
+    # processes (which need a real filesystem).
+    for (filesystem, processes) in [(fs.memoryfs.MemoryFS(), None),
+                                    (fs.tempfs.TempFS(), 4)]:
+        data = data_generator()
+        new_data = megasort(data,
+                            filesystem,
+                            file_limit=FILE_LIMIT,
+                            ramsize=RAM_SIZE,
+                            # key=lambda x:"".join(reversed(x)),
+                            breakpoints="1234567890abcdef",
+                            processes=processes)
+
+        old_item = None
+        c = []
+        d = []
+        for item in new_data:
+            if old_item:
+                c.append(item > old_item)
+                d.append(item == old_item)
+            old_item = item
+        if len(c)+1 != ITEM_COUNT:
+            raise "We did not have the correct number of items"
+        if not reduce((lambda x, y: x and y), c):
+            raise "Items were not in the correct order"
+        if reduce((lambda x, y: x or y), d):
+            raise "Possible duplicate item"
+        if filesystem.listdir():
+            raise "Temporary files were left behind"
@@ -19,15 +19,25 @@ Caveats:
 * The data comes back a little out-of-order. This is by design. We
   could tag data such that it came back in-order, but it'd add
   performance overhead, and prevent some types of accumulation use cases.
+
+ParallelPipeline addresses these caveats. It is an object, so it can
+be used many times in a program. It ships items in chunks, which cuts
+the per-item serialization overhead that often cancels out the gains
+from split()/join(). It can keep items in order (chunks are tagged
+with sequence numbers, so this is cheap), and it can run a reducer
+inside the workers for commutative accumulations.
 '''
 
 import itertools
 import os
 import sentinel
 import sys
+import threading
 import time
+import traceback
 
-from multiprocessing import Queue
+from multiprocessing import Process, Queue
+from Queue import Empty, Full
 
 
 _pid = None
@@ -141,6 +151,189 @@ def join(data):
     return []
 
 
+class ParallelPipeline(object):
+    '''
+    Run a stream processing stage over several processes.
+
+    `stage` is a function which takes an iterable and returns an
+    iterable (like most of the functions in `streaming`). Input is
+    broken into chunks of `chunk_size` items; each worker runs `stage`
+    over each chunk it gets. Since stage is called once per chunk, it
+    shouldn't keep state between items.
+
+    Workers are forked, so `stage` doesn't need to be picklable, but
+    items and results do. If a worker dies (e.g. it runs out of
+    memory), we raise RuntimeError rather than waiting for it.
+
+    >>> double = ParallelPipeline(lambda d: (x * 2 for x in d),
+    ...                           processes=3, chunk_size=7)
+    >>> list(double.map(range(50))) == [x * 2 for x in range(50)]
+    True
+    >>> total = ParallelPipeline(lambda d: d, processes=3,
+    ...                          reducer=lambda a, b: a + b, initial=0)
+    >>> total.reduce(range(101))
+    5050
+    '''
+    def __init__(self,
+                 stage,
+                 processes=8,
+                 chunk_size=1000,
+                 ordered=True,
+                 reducer=None,
+                 initial=None,
+                 combiner=None):
+        '''
+        If `ordered`, map() returns results in input order. Otherwise,
+        chunks come back as they finish. Either way, at most
+        `processes * 4` chunks are out at once, so one slow chunk can
+        only hold up so many finished chunks behind it.
+
+        `reducer(accumulator, item)` lets reduce() accumulate results
+        inside the workers, starting from `initial`. The per-worker
+        accumulators are then merged in this process with
+        `combiner(accumulator, accumulator)`, which defaults to
+        `reducer`. This only makes sense for commutative and
+        associative accumulations.
+        '''
+        self.stage = stage
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+        self.reducer = reducer
+        self.initial = initial
+        self.combiner = combiner or reducer
+
+    def _work(self, qin, qout, reducing):
+        '''
+        Worker process main loop.
+        '''
+        try:
+            accumulator = self.initial
+            for (seq, chunk) in iter(qin.get, EndOfQueue):
+                results = self.stage(chunk)
+                if reducing:
+                    for item in results:
+                        accumulator = self.reducer(accumulator, item)
+                else:
+                    qout.put(('chunk', seq, list(results)))
+            if reducing:
+                qout.put(('reduced', None, accumulator))
+            qout.put(('done', None, None))
+        except:
+            qout.put(('error', None, traceback.format_exc()))
+        qout.close()
+        qout.join_thread()
+
+    def _run(self, data, reducing, in_flight=None):
+        '''
+        Start the workers and a feeder thread. Yields the messages
+        workers send back, until all of them are done.
+
+        If given, `in_flight` (a threading.Semaphore) is acquired
+        before each chunk is sent out. The caller releases it as it
+        finishes with chunks.
+        '''
+        qin = Queue(maxsize=self.processes * 2)
+        qout = Queue(maxsize=self.processes * 2)
+        workers = [Process(target=self._work, args=(qin, qout, reducing))
+                   for i in range(self.processes)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        feed_error = []
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    qin.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def feed():
+            try:
+                data_iter = iter(data)
+                for seq in itertools.count():
+                    chunk = list(itertools.islice(data_iter, self.chunk_size))
+                    if not chunk:
+                        break
+                    if in_flight:
+                        in_flight.acquire()
+                    if not put((seq, chunk)):
+                        return
+            except:
+                feed_error.append(traceback.format_exc())
+            for worker in workers:
+                put(EndOfQueue)
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        try:
+            done = 0
+            while done < self.processes:
+                try:
+                    (kind, seq, payload) = qout.get(timeout=1)
+                except Empty:
+                    for worker in workers:
+                        if worker.exitcode not in (None, 0):
+                            raise RuntimeError(
+                                "Worker died (exit code {code})".format(
+                                    code=worker.exitcode))
+                    continue
+                if kind == 'error':
+                    raise RuntimeError("Worker failed:\n" + payload)
+                elif kind == 'done':
+                    done = done + 1
+                else:
+                    yield (kind, seq, payload)
+            if feed_error:
+                raise RuntimeError("Reading input failed:\n" + feed_error[0])
+            for worker in workers:
+                worker.join()
+        finally:
+            stopped.set()
+            if in_flight:
+                in_flight.release()  # In case the feeder is waiting
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+
+    def map(self, data):
+        '''
+        Run the stage over `data`. Returns an iterator of the results.
+        '''
+        waiting = {}
+        next_seq = 0
+        in_flight = threading.Semaphore(self.processes * 4)
+        for (kind, seq, results) in self._run(data, False, in_flight):
+            if not self.ordered:
+                in_flight.release()
+                for item in results:
+                    yield item
+                continue
+            waiting[seq] = results
+            while next_seq in waiting:
+                in_flight.release()
+                for item in waiting.pop(next_seq):
+                    yield item
+                next_seq = next_seq + 1
+
+    def reduce(self, data):
+        '''
+        Run the stage over `data`, and accumulate the results with
+        the reducer. Returns the accumulated value.
+        '''
+        if self.reducer is None:
+            raise AttributeError("reduce() needs a reducer")
+        accumulators = [payload for (kind, seq, payload)
+                        in self._run(data, True)]
+        return reduce(self.combiner, accumulators)
+
+
 # If we run directly, we do a quick test. We split 100 1 second sleeps among
 # 8 processes. If we're working fine, this will take 12 seconds.
 #
@@ -159,3 +352,6 @@ if __name__ == '__main__':
     data = list(data)
     print len(data)
     print data
+
+    import doctest
+    doctest.testmod()
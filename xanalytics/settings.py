@@ -121,7 +121,14 @@ def _fslookup(namespace, directory, compress):
         path = basepath
 
     if compress:
-        return GZIPFS(path)
+        # e.g. `scratch-codec: zstd`, `scratch-compression-level: 3`,
+        # `output-compression-threads: 8`
+        prefix = directory[:-len('-dir')]
+        return GZIPFS(path,
+                      codec=settings.get(prefix + '-codec', 'gzip'),
+                      level=settings.get(prefix + '-compression-level'),
+                      threads=settings.get(prefix + '-compression-threads'),
+                      block_size=settings.get(prefix + '-compression-block'))
     else:
         return fs.osfs.OSFS(path)
 
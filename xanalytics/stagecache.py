@@ -0,0 +1,300 @@
+'''
+A content-addressed cache for the results of pipeline stages.
+
+In notebook work, we re-run the same prefix of a pipeline (read,
+decode, desensitize, ...) many times a day. Wrapping that prefix as
+a stage caches its output:
+
+    @cached_stage()
+    def course_events(filesystem, course):
+        return filter_on_courses(text_to_json(read_data(filesystem)),
+                                 [course])
+
+    events = course_events(edxdatafs(), "MITx/6.002x/2012_Fall")
+
+Results are keyed on a hash of:
+
+* The stage (its name, and its byte code, so editing the stage
+  invalidates the cache)
+* Its inputs. Filesystem arguments are hashed by the names, sizes,
+  and modification times of the files in them, so the key changes
+  when the underlying data does
+* Its other parameters
+
+On the first run, results are written to the cache as they stream
+through. The entry only becomes visible once the stream has been
+read to the end, so a partly-consumed run never leaves a truncated
+entry behind. Later runs read the cache instead.
+
+Entries are stored in `settings.scratchfs("stagecache")` as blocks
+of pickled items, which decode several times faster than JSON. Once
+the cache is larger than its byte budget (the `stage-cache-size`
+setting, 10G by default), the least recently used entries are
+removed.
+'''
+
+import cPickle
+import datetime
+import functools
+import inspect
+import json
+import md5
+import struct
+import uuid
+
+from fs.base import FS
+from fs.errors import UnsupportedError
+
+import xanalytics.settings
+
+from xanalytics.gzipfs import codecs
+from xanalytics.megasort import parse_size
+from xanalytics.streaming import batch, _open_raw
+
+_EXTENSION = ".stage"
+
+
+def fingerprint(filesystem, path="/"):
+    '''
+    Return a hash of the files in a pyfs filesystem: their names,
+    sizes, and modification times. We never open the files, so this
+    is cheap even for large data sets.
+
+    Hidden files (and directories) are skipped, as in
+    `streaming.get_files`. Those hold bookkeeping, like catalogs and
+    gzip indexes, which change without the data changing.
+
+    >>> import fs.memoryfs
+    >>> data = fs.memoryfs.MemoryFS()
+    >>> _ = data.setcontents("log", "{}\\n")
+    >>> before = fingerprint(data)
+    >>> _ = data.setcontents(".catalog.json", "{}")
+    >>> fingerprint(data) == before
+    True
+    >>> _ = data.setcontents("log2", "{}\\n")
+    >>> fingerprint(data) == before
+    False
+    '''
+    digest = md5.new(str(filesystem))
+    for filename in sorted(filesystem.walkfiles(path)):
+        if any(part.startswith(".") for part in filename.split("/")):
+            continue
+        info = filesystem.getinfo(filename)
+        digest.update(repr((filename,
+                            info.get('size'),
+                            str(info.get('modified_time')))))
+    return digest.hexdigest()
+
+
+def _code_hash(code):
+    '''
+    Helper: Hash a function's byte code and constants, including
+    those of nested functions, so the key changes when the stage is
+    edited.
+    '''
+    digest = md5.new(code.co_code)
+    for constant in code.co_consts:
+        if inspect.iscode(constant):
+            digest.update(_code_hash(constant))
+        else:
+            digest.update(repr(constant))
+    return digest.hexdigest()
+
+
+def _parameter(value):
+    '''
+    Helper: Turn a stage parameter into a string for the cache key.
+
+    >>> _parameter({"b": 1, "a": [1, 2]})
+    '{"a": [1, 2], "b": 1}'
+    '''
+    if isinstance(value, FS):
+        return fingerprint(value)
+    if inspect.isgenerator(value) or \
+       (hasattr(value, "next") and hasattr(value, "__iter__")):
+        raise TypeError("Stages can't be keyed on a stream. Pass "
+                        "the filesystem it comes from instead.")
+    return json.dumps(value, sort_keys=True, default=repr)
+
+
+class StageCache(object):
+    '''
+    A cache of stage results in a pyfs filesystem (by default,
+    `settings.scratchfs("stagecache", compress=False)`), with at most
+    `max_bytes` of entries (by default, the `stage-cache-size`
+    setting).
+
+    >>> import fs.memoryfs
+    >>> cache = StageCache(fs.memoryfs.MemoryFS())
+    >>> key = cache.key("squares", [3])
+    >>> list(cache.cached(key, lambda: (i * i for i in range(3))))
+    [0, 1, 4]
+    >>> list(cache.cached(key, lambda: None))
+    [0, 1, 4]
+    '''
+    def __init__(self,
+                 filesystem=None,
+                 max_bytes=None,
+                 codec='gzip',
+                 level=1,
+                 batch_size=1000):
+        if filesystem is None:
+            filesystem = xanalytics.settings.scratchfs("stagecache",
+                                                       compress=False)
+        if max_bytes is None:
+            max_bytes = xanalytics.settings.settings.get('stage-cache-size',
+                                                         "10G")
+        codecs.check(codec)
+        self.filesystem = filesystem
+        self.max_bytes = parse_size(max_bytes)
+        self.codec = codec
+        self.level = level
+        self.batch_size = batch_size
+
+    def key(self, name, args=(), kwargs=None):
+        '''
+        Compute the cache key for a stage called with the given
+        arguments.
+        '''
+        parts = [name] + [_parameter(arg) for arg in args]
+        for keyword in sorted(kwargs or {}):
+            parts.append(keyword + "=" + _parameter(kwargs[keyword]))
+        return md5.new("\n".join(parts)).hexdigest()
+
+    def _path(self, key):
+        return key + _EXTENSION
+
+    def __contains__(self, key):
+        return self.filesystem.exists(self._path(key))
+
+    def _touch(self, path):
+        '''
+        Helper: Mark an entry as recently used.
+        '''
+        now = datetime.datetime.now()
+        try:
+            self.filesystem.settimes(path, now, now)
+        except UnsupportedError:
+            pass
+
+    def _read(self, path):
+        fp = _open_raw(self.filesystem, path)
+        codec = codecs.CODECS[ord(fp.read(1))]
+        while True:
+            header = fp.read(4)
+            if len(header) < 4:
+                break
+            length = struct.unpack('<I', header)[0]
+            items = cPickle.loads(codecs.decompress(fp.read(length), codec))
+            for item in items:
+                yield item
+        fp.close()
+
+    def _tee(self, path, data):
+        '''
+        Helper: Pass `data` through, writing it to a temporary file,
+        which becomes the entry at `path` once `data` is exhausted.
+        '''
+        temporary = ".{uuid}.tmp".format(uuid=uuid.uuid1().hex)
+        fp = _open_raw(self.filesystem, temporary, 'wb')
+        fp.write(chr(codecs.CODECS.index(self.codec)))
+        complete = False
+        try:
+            for items in batch(data, self.batch_size):
+                block = codecs.compress(cPickle.dumps(items, 2),
+                                        self.codec,
+                                        self.level)
+                fp.write(struct.pack('<I', len(block)))
+                fp.write(block)
+                for item in items:
+                    yield item
+            complete = True
+        finally:
+            fp.close()
+            if complete:
+                if self.filesystem.exists(path):
+                    self.filesystem.remove(path)
+                self.filesystem.rename(temporary, path)
+                self.evict()
+            else:
+                self.filesystem.remove(temporary)
+
+    def cached(self, key, compute):
+        '''
+        Return the cached stream for `key`. If there isn't one, call
+        `compute()` for the stream, and cache it as it is read.
+        '''
+        path = self._path(key)
+        if self.filesystem.exists(path):
+            self._touch(path)
+            return self._read(path)
+        return self._tee(path, compute())
+
+    def entries(self):
+        '''
+        Return (last used, size, path) for each entry, oldest first.
+        '''
+        entries = []
+        for path in self.filesystem.listdir(wildcard="*" + _EXTENSION):
+            info = self.filesystem.getinfo(path)
+            entries.append((info.get('modified_time'), info['size'], path))
+        return sorted(entries)
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache fits in
+        its byte budget.
+        '''
+        entries = self.entries()
+        total = sum(size for (used, size, path) in entries)
+        for (used, size, path) in entries:
+            if total <= self.max_bytes:
+                break
+            self.filesystem.remove(path)
+            total = total - size
+
+    def clear(self):
+        '''
+        Remove all entries.
+        '''
+        for (used, size, path) in self.entries():
+            self.filesystem.remove(path)
+
+
+def cached_stage(cache=None, name=None):
+    '''
+    Decorator which caches the output of a stage (a function which
+    returns a stream) in a `StageCache`. See the module documentation.
+
+    >>> import fs.memoryfs
+    >>> calls = []
+    >>> @cached_stage(StageCache(fs.memoryfs.MemoryFS()))
+    ... def numbers(count, offset=0):
+    ...     calls.append(count)
+    ...     return (i + offset for i in range(count))
+    >>> list(numbers(3, offset=1))
+    [1, 2, 3]
+    >>> list(numbers(3, offset=1))
+    [1, 2, 3]
+    >>> list(numbers(2))
+    [0, 1]
+    >>> calls
+    [3, 2]
+    '''
+    def decorator(function):
+        stage = "{name}:{code}".format(
+            name=name or function.__module__ + "." + function.__name__,
+            code=_code_hash(function.__code__))
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            stage_cache = cache or StageCache()
+            return stage_cache.cached(stage_cache.key(stage, args, kwargs),
+                                      lambda: function(*args, **kwargs))
+        return wrapper
+    return decorator
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -17,31 +17,66 @@ For best practices.
 
 '''
 
+import Queue
 import argparse
+import base64
+import collections
+import datetime
 import dateutil.parser
+import dateutil.tz
 import gzip
 import itertools
 import md5
+import multiprocessing
+import multiprocessing.pool
 import numbers
 import os
+import re
 import string
 import struct
+import sys
+import traceback
 import warnings
+import zlib
 
 try:
     import simplejson as json
 except:
     import json
 
+# For hot loops, we decode with the fastest JSON library we can
+# find. These all raise a subclass of ValueError on bad input.
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        _json_loads = ujson.loads
+    except ImportError:
+        _json_loads = json.loads
+
+# Optional: lets Sharder.batch hash many keys at once
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 from fs.base import FS
+from fs.errors import UnsupportedError
+from fs.path import basename
+from fs.watch import CREATED, MODIFIED, MOVED_DST
 
 import fs.osfs
 
 from bson import BSON
 
+import xanalytics.bsonarchive
 import xanalytics.settings
 
+from xanalytics.gzipfs import CompressedFS, GZIPFS, codecs
+
 ######
 # Generic functions to stream processing in Python
 ######
@@ -80,7 +115,233 @@ def _to_filesystem(filesystem_or_directory):
         raise AttributeError(error)
 
 
-def get_files(filesystem, directory=".", only_gz=False):
+_UTC_TIME = re.compile(r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?)"
+                       r"(?:Z|[+-]00:?00)?$")
+
+
+def time_key(time):
+    '''
+    Turn a time string into a string which sorts in time order: ISO
+    8601, in UTC, without a time zone. edX times (e.g.
+    2014-01-02T03:04:05.123456+00:00) are just sliced. Anything else
+    goes through dateutil, which is much slower.
+
+    >>> time_key("2014-01-02T03:04:05.123456+00:00")
+    '2014-01-02T03:04:05.123456'
+    >>> time_key("2014-01-02T05:04:05+02:00")
+    '2014-01-02T03:04:05'
+    >>> time_key("Jan 2 2014")
+    '2014-01-02T00:00:00'
+    '''
+    match = _UTC_TIME.match(time)
+    if match:
+        return str(match.group(1))
+    moment = dateutil.parser.parse(time)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(dateutil.tz.tzutc()).replace(tzinfo=None)
+    return moment.isoformat()
+
+
+# Per-directory catalog of what is in each file, so we can skip files
+# without opening them.
+_CATALOG = ".catalog.json"
+# Past this many distinct values, we stop listing a file's courses or
+# event types (some old event types are URLs), and don't prune on them.
+_CATALOG_MAX_VALUES = 1000
+_TIME_PATTERN = re.compile(r'"time"\s*:\s*"([^"]*)"')
+
+
+class BloomFilter(object):
+    '''
+    A simple Bloom filter over strings. It may say a string is in the
+    set when it isn't (about 1% of the time, at the default size),
+    but never the reverse.
+
+    >>> users = BloomFilter(100)
+    >>> users.add("alice")
+    >>> "alice" in users, "bob" in users
+    (True, False)
+    >>> "alice" in BloomFilter.from_string(users.to_string())
+    True
+    '''
+    def __init__(self, capacity=1000, hashes=7, bits=None):
+        self.hashes = hashes
+        self.bits = bytearray((bits or max(capacity * 10, 64)) // 8)
+
+    def _positions(self, item):
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        digest = md5.new(item).digest()
+        (a, b) = struct.unpack('<QQ', digest)
+        size = len(self.bits) * 8
+        return [(a + i * b) % size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, item):
+        return all(self.bits[position // 8] & (1 << (position % 8))
+                   for position in self._positions(item))
+
+    def to_string(self):
+        return "{hashes}:{bits}".format(
+            hashes=self.hashes,
+            bits=base64.b64encode(str(self.bits)))
+
+    @classmethod
+    def from_string(cls, string):
+        (hashes, bits) = string.split(":", 1)
+        bloom = cls(hashes=int(hashes))
+        bloom.bits = bytearray(base64.b64decode(bits))
+        return bloom
+
+
+def _scan_file(filesystem, path):
+    '''
+    Helper: Build the catalog entry for a file of text events: the
+    number of lines, the first and last time (as time_keys), the
+    courses and event types, and a Bloom filter of usernames.
+    '''
+    lines = [0]
+    (first, last) = (None, None)
+    courses = set()
+    event_types = set()
+    usernames = set()
+
+    def count(data):
+        for line in data:
+            lines[0] = lines[0] + 1
+            yield line
+
+    for events in text_to_json_batches(batch(count(filesystem.open(path)))):
+        for event in events:
+            time = event.get('time')
+            if isinstance(time, basestring):
+                try:
+                    time = time_key(time)
+                except ValueError:
+                    time = None
+                if time is not None and (first is None or time < first):
+                    first = time
+                if time is not None and (last is None or time > last):
+                    last = time
+            context = event.get('context')
+            if isinstance(context, dict):
+                courses.add(context.get('course_id'))
+            event_types.add(event.get('event_type'))
+            usernames.add(event.get('username'))
+
+    bloom = BloomFilter(len(usernames))
+    for username in usernames:
+        if isinstance(username, basestring):
+            bloom.add(username)
+    return {'lines': lines[0],
+            'min_time': first,
+            'max_time': last,
+            'courses': sorted(courses)
+            if len(courses) <= _CATALOG_MAX_VALUES else None,
+            'event_types': sorted(event_types)
+            if len(event_types) <= _CATALOG_MAX_VALUES else None,
+            'usernames': bloom.to_string()}
+
+
+def _file_stamp(filesystem, path):
+    '''
+    Helper: Size and modification time, to tell if a file changed.
+    '''
+    info = filesystem.getinfo(path)
+    return (info.get('size'), str(info.get('modified_time')))
+
+
+def load_catalog(filesystem, directory="."):
+    '''
+    Load the catalog of a directory (see `build_catalog`). Returns an
+    empty dictionary if there isn't one.
+    '''
+    filesystem = _to_filesystem(filesystem)
+    path = directory + "/" + _CATALOG
+    if not filesystem.exists(path):
+        return {}
+    return json.load(_open_raw(filesystem, path, 'r'))
+
+
+def build_catalog(filesystem, directory=".", only_gz=False):
+    '''
+    Catalog what is in each file of text events in a directory (for
+    example, `settings.edxdatafs()`), so `read_data` can skip files
+    without opening them. The catalog is kept in the directory, in
+    `.catalog.json`, and only new or changed files are scanned, so
+    this is cheap to re-run as logs come in.
+
+    Returns the catalog, a dictionary mapping file names to entries.
+    Each entry is a dictionary with the file's `size`, `modified`
+    time, number of `lines`, `min_time` and `max_time` of its events,
+    the `courses` and `event_types` in it (None if there are too many
+    to list), and a Bloom filter of `usernames` (see `file_filter`).
+    '''
+    filesystem = _to_filesystem(filesystem)
+    old_catalog = load_catalog(filesystem, directory)
+    catalog = {}
+    for f in get_files(filesystem, directory, only_gz):
+        path = directory + "/" + f
+        (size, modified) = _file_stamp(filesystem, path)
+        entry = old_catalog.get(f)
+        if entry is None or \
+           (entry['size'], entry['modified']) != (size, modified):
+            entry = _scan_file(filesystem, path)
+            entry['size'] = size
+            entry['modified'] = modified
+        catalog[f] = entry
+    temporary = directory + "/" + _CATALOG + ".tmp"
+    fp = _open_raw(filesystem, temporary, 'w')
+    json.dump(catalog, fp)
+    fp.close()
+    if filesystem.exists(directory + "/" + _CATALOG):
+        filesystem.remove(directory + "/" + _CATALOG)
+    filesystem.rename(temporary, directory + "/" + _CATALOG)
+    return catalog
+
+
+def file_filter(courses=None, event_types=None, usernames=None,
+                time_range=None):
+    '''
+    Build a predicate on catalog entries, for `read_data`'s `where`,
+    which is false for files that can't have events in one of the
+    `courses`, of one of the `event_types`, by one of the `usernames`,
+    and in the (inclusive) `time_range`. Any of these may be None.
+
+    >>> where = file_filter(courses=["MITx/6.002x"])
+    >>> where({'courses': ["MITx/6.002x", None]}), where({'courses': []})
+    (True, False)
+    '''
+    if time_range is not None:
+        time_range = tuple(None if t is None else time_key(t)
+                           for t in time_range)
+
+    def where(entry):
+        if courses is not None and entry.get('courses') is not None and \
+           not set(courses) & set(entry['courses']):
+            return False
+        if event_types is not None and \
+           entry.get('event_types') is not None and \
+           not set(event_types) & set(entry['event_types']):
+            return False
+        if usernames is not None and entry.get('usernames') is not None:
+            bloom = BloomFilter.from_string(entry['usernames'])
+            if not any(username in bloom for username in usernames):
+                return False
+        if time_range is not None and entry.get('min_time') is not None:
+            (min_time, max_time) = time_range
+            if min_time is not None and entry['max_time'] < min_time:
+                return False
+            if max_time is not None and entry['min_time'] > max_time:
+                return False
+        return True
+    return where
+
+
+def get_files(filesystem, directory=".", only_gz=False, where=None):
     '''
     Return an iterator of all the files in a given directory or pyfilesystem.
     >>> "__init__.py" in list(get_files("."))
@@ -88,15 +349,34 @@ def get_files(filesystem, directory=".", only_gz=False):
     >>> import fs.osfs
     >>> "__init__.py" in list(get_files(fs.osfs.OSFS(".")))
     True
+
+    Hidden files (e.g. the catalog, or the indexes GZIPFS keeps) are
+    skipped.
+
+    If `where` is given, files for which the directory's catalog
+    entry (see `build_catalog`) fails `where(entry)` are skipped.
+    Files which aren't in the catalog, or which changed since they
+    were cataloged, are always returned.
     '''
     filesystem = _to_filesystem(filesystem)
+    catalog = {}
+    if where is not None:
+        catalog = load_catalog(filesystem, directory)
     for f in sorted(filesystem.listdir(directory)):
         if only_gz and not f.endswith(".gz"):
             continue
+        if f.startswith("."):
+            continue
+        entry = catalog.get(f)
+        if entry is not None and \
+           (entry['size'], entry['modified']) == \
+           _file_stamp(filesystem, directory + "/" + f) and \
+           not where(entry):
+            continue
         yield f
 
 
-def _read_text_data(filesystem, directory=".", only_gz=False):
+def _read_text_data(filesystem, directory=".", only_gz=False, where=None):
     '''
     Helper: Yield all the lines in all the files in a directory.
 
@@ -105,18 +385,345 @@ def _read_text_data(filesystem, directory=".", only_gz=False):
     '''
     filesystem = _to_filesystem(filesystem)
 
-    for f in filesystem.listdir(directory):
-        if only_gz and not f.endswith(".gz"):
-            continue
+    for f in get_files(filesystem, directory, only_gz, where):
         for line in filesystem.open(directory + "/" + f):
             yield line.encode('ascii', 'ignore')
 
 
-def _read_bson_data(filesystem, directory):
+# Files in a GZIPFS larger than this are split into byte ranges, and
+# the gzip members within each range are decompressed independently.
+_GZIP_CHUNK_SIZE = 32 * 1024 * 1024
+_GZIP_MAGIC = '\x1f\x8b\x08'
+# Workers send text back in batches of lines of about this many bytes,
+# and each can have up to _WORKER_BACKLOG batches waiting for us.
+_TEXT_CHUNK_SIZE = 1024 * 1024
+_WORKER_BACKLOG = 4
+
+
+def _split_text(text):
+    '''
+    Helper: Break text into a list of pieces. The first and last
+    pieces may be partial lines (they need to be stitched with
+    adjacent chunks). All the others are complete lines.
+
+    >>> _split_text("a\\nb\\nc")
+    ['a\\n', 'b\\n', 'c']
+    >>> _split_text("abc")
+    ['abc']
+    '''
+    pieces = text.split('\n')
+    pieces = [piece + '\n' for piece in pieces[:-1]] + pieces[-1:]
+    return [piece.encode('ascii', 'ignore') for piece in pieces]
+
+
+def _inflate_member(fp, offset, write=None):
+    '''
+    Helper: Decompress the gzip member which starts at `offset` in
+    the raw file `fp`, passing the text to `write` a block at a time
+    (or dropping it, if there is no `write`). Returns the offset
+    where the next member starts.
+
+    Raises zlib.error if there is no complete, valid member at
+    `offset`. Since the gzip trailer has a CRC, this is a reliable way
+    to tell real member headers from bytes which just happen to look
+    like one.
+    '''
+    fp.seek(offset)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    consumed = 0
+    while True:
+        block = fp.read(256 * 1024)
+        if not block:
+            # zlib in Python 2 won't tell us if the stream ended. If
+            # it did, a trailing byte lands in unused_data.
+            decompressor.decompress('\x00')
+            if not decompressor.unused_data:
+                raise zlib.error("Truncated gzip member")
+            return offset + consumed
+        consumed = consumed + len(block)
+        while block:
+            # Tracking logs compress very well, so we cap how much
+            # text we get back at a time.
+            text = decompressor.decompress(block, _TEXT_CHUNK_SIZE)
+            if write and text:
+                write(text)
+            block = decompressor.unconsumed_tail
+        if decompressor.unused_data:
+            return offset + consumed - len(decompressor.unused_data)
+
+
+class _LineSender(object):
+    '''
+    Helper (runs in worker processes): Collects text, and sends it
+    to the parent through `results` in lists of about
+    `_TEXT_CHUNK_SIZE` bytes of lines (as with _split_text). So we
+    never hold much more than that of a file, however large the file
+    or its gzip members are.
+    '''
+    def __init__(self, results):
+        self.results = results
+        self.text = []
+        self.size = 0
+
+    def write(self, text):
+        self.text.append(text)
+        self.size = self.size + len(text)
+        if self.size >= _TEXT_CHUNK_SIZE:
+            text = "".join(self.text)
+            end = text.rfind('\n') + 1
+            if end:
+                self.results.put(('text', _split_text(text[:end])))
+                text = text[end:]
+            self.text = [text]
+            self.size = len(text)
+
+    def close(self):
+        text = "".join(self.text)
+        if text:
+            self.results.put(('text', _split_text(text)))
+        self.text = []
+        self.size = 0
+
+
+def _read_gzip_range(syspath, start, end, write):
+    '''
+    Helper (runs in worker processes): Decompress the gzip members of
+    a file which start in the byte range [start, end), passing the
+    text to `write`.
+
+    The range boundaries are arbitrary byte offsets. We search forward
+    from `start` for the first real member header. The last member we
+    decode may run past `end`; the worker handling the next range will
+    skip over it, since it won't find a valid header inside it. A
+    file which is one big member is decoded by the worker with the
+    first range, and sent back in pieces as it goes.
+    '''
+    fp = open(syspath, 'rb')
+    offset = start
+    if start > 0:
+        # Find the first member which starts in our range. We check
+        # it all the way to its CRC before we send any of it.
+        fp.seek(start)
+        window = fp.read(end - start + len(_GZIP_MAGIC) - 1)
+        position = window.find(_GZIP_MAGIC)
+        while position != -1:
+            try:
+                _inflate_member(fp, start + position)
+                offset = start + position
+                break
+            except zlib.error:
+                position = window.find(_GZIP_MAGIC, position + 1)
+        if position == -1:
+            fp.close()
+            return
+    while offset < end:
+        fp.seek(offset)
+        if not fp.read(1):
+            break
+        offset = _inflate_member(fp, offset, write)
+    fp.close()
+
+
+def _read_whole_file(filesystem, path, write):
+    '''
+    Helper (runs in worker processes): Read all of a file through the
+    filesystem, passing the text to `write` a block at a time.
+    '''
+    fp = filesystem.open(path)
+    for text in iter(lambda: fp.read(_TEXT_CHUNK_SIZE), ''):
+        write(text)
+    fp.close()
+
+
+def _read_worker(tasks, results):
+    '''
+    Helper: Worker process main loop for _read_text_data_parallel.
+    Runs read tasks from `tasks` until it gets None. The text of each
+    goes back through `results`, followed by a 'done' message.
+    '''
+    for task in iter(tasks.get, None):
+        try:
+            sender = _LineSender(results)
+            if task[0] == 'range':
+                _read_gzip_range(*(task[1:] + (sender.write,)))
+            else:
+                _read_whole_file(*(task[1:] + (sender.write,)))
+            sender.close()
+            results.put(('done', None))
+        except:
+            results.put(('error', traceback.format_exc()))
+    results.close()
+    results.join_thread()
+
+
+def _read_tasks(filesystem, directory, only_gz, chunk_size, where=None):
+    '''
+    Helper: Break all the files in a directory into tasks for
+    _read_text_data_parallel. Yields (file number, last chunk?,
+    task) tuples.
+
+    Large gzip files in a GZIPFS are split into byte ranges. Anything
+    else (including zstd and lz4 files) is read whole.
+    '''
+    for (file_number, f) in enumerate(get_files(filesystem,
+                                                directory,
+                                                only_gz,
+                                                where)):
+        path = directory + "/" + f
+        size = filesystem.getinfo(path)['size']  # Compressed size
+        if isinstance(filesystem, GZIPFS) and size > chunk_size:
+            syspath = filesystem.getsyspath(path)
+            with open(syspath, 'rb') as fp:
+                if codecs.detect(fp.read(4)) != 'gzip':
+                    yield (file_number, True, ('file', filesystem, path))
+                    continue
+            starts = range(0, size, chunk_size)
+            for start in starts:
+                task = ('range', syspath, start, start + chunk_size)
+                yield (file_number, start == starts[-1], task)
+        else:
+            yield (file_number, True, ('file', filesystem, path))
+
+
+def _read_text_data_parallel(filesystem,
+                             directory=".",
+                             only_gz=False,
+                             processes=None,
+                             ordered=True,
+                             chunk_size=_GZIP_CHUNK_SIZE,
+                             where=None):
+    '''
+    Helper: Yield batches (lists) of all the lines in all the files in
+    a directory. Decompression and line-splitting happen in
+    `processes` worker processes.
+
+    If `ordered`, batches come out in file name order (as with
+    get_files). Otherwise, files come out in whatever order they
+    finish in (lines within a file stay in order), which keeps all
+    the workers busy if file sizes are uneven.
+
+    Each worker sends its text back a batch of lines at a time, and
+    can have at most `_WORKER_BACKLOG` batches waiting for us. Memory
+    use is bounded by that, rather than by file sizes, and slow
+    consumers slow the workers down rather than filling memory.
+    '''
+    filesystem = _to_filesystem(filesystem)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    tasks = _read_tasks(filesystem, directory, only_gz, chunk_size, where)
+    # One (process, task queue, result queue) per worker. Each worker
+    # has its own result queue, so a worker which is ahead of us
+    # blocks when its queue is full, rather than crowding out the
+    # worker we're waiting on.
+    workers = []
+    for i in range(processes):
+        queues = (multiprocessing.Queue(),
+                  multiprocessing.Queue(maxsize=_WORKER_BACKLOG))
+        process = multiprocessing.Process(target=_read_worker, args=queues)
+        process.daemon = True
+        process.start()
+        workers.append((process,) + queues)
+    idle = list(workers)
+    running = []  # [file, chunk, last?, worker], in the order submitted
+    next_chunk = collections.defaultdict(int)
+    chunk_numbers = collections.defaultdict(int)
+    carry = collections.defaultdict(str)
+
+    def submit():
+        for (file_number, last, task) in itertools.islice(tasks, 1):
+            chunk = chunk_numbers[file_number]
+            chunk_numbers[file_number] = chunk + 1
+            worker = idle.pop()
+            worker[1].put(task)
+            running.append((file_number, chunk, last, worker))
+
+    def receive():
+        '''
+        Wait for the next message from a worker whose text we can
+        use now: the oldest task if we're `ordered`, or otherwise,
+        the oldest task of any file.
+        '''
+        while True:
+            if ordered:
+                candidates = running[:1]
+            else:
+                candidates = [item for item in running
+                              if item[1] == next_chunk[item[0]]]
+            for item in candidates:
+                try:
+                    return (item, item[3][2].get(timeout=0.05))
+                except Queue.Empty:
+                    pass
+                if not item[3][0].is_alive() and item[3][2].empty():
+                    raise RuntimeError("Read worker died (exit code {code})"
+                                       .format(code=item[3][0].exitcode))
+
+    try:
+        for worker in workers:
+            submit()
+        while running:
+            (item, (kind, payload)) = receive()
+            (file_number, chunk, last, worker) = item
+            if kind == 'error':
+                raise RuntimeError("Read worker failed:\n" + payload)
+            elif kind == 'text':
+                if len(payload) > 1:
+                    batch = [carry[file_number] + payload[0]] + payload[1:-1]
+                    carry[file_number] = payload[-1]
+                else:
+                    batch = []
+                    carry[file_number] = carry[file_number] + payload[0]
+                if batch:
+                    yield batch
+                continue
+            running.remove(item)
+            idle.append(worker)
+            submit()
+            next_chunk[file_number] = chunk + 1
+            if last:
+                del next_chunk[file_number]
+                tail = carry.pop(file_number, '')
+                if tail:
+                    yield [tail]
+    finally:
+        for (process, task_queue, results) in workers:
+            if process.is_alive():
+                process.terminate()
+
+
+def _open_raw(filesystem, path, mode='rb'):
+    '''
+    Helper: Open a file without transparent compression. A GZIPFS
+    or CompressedFS would otherwise gzip our already-compressed
+    archives.
+    '''
+    if isinstance(filesystem, GZIPFS):
+        return open(filesystem.getsyspath(path), mode)
+    if isinstance(filesystem, CompressedFS):
+        return filesystem.wrapped_fs.open(path, mode)
+    return filesystem.open(path, mode)
+
+
+def _read_bson_data(filesystem, directory, only_gz=False, time_range=None):
+    '''
+    Helper: Yield all the records in all the BSON archives in a
+    directory. If an archive has an index, we use it to skip blocks
+    outside of `time_range`.
+    '''
     for f in get_files(filesystem, directory, only_gz):
-        fp = filesystem.open(os.path.join(directory, f))
-        for line in _read_bson_file(fp):
-            yield line
+        if f.endswith(".idx"):
+            continue
+        path = directory + "/" + f
+        index_path = xanalytics.bsonarchive.index_path(path)
+        index = None
+        if filesystem.exists(index_path):
+            index = xanalytics.bsonarchive.read_index(
+                _open_raw(filesystem, index_path, 'r'))
+        fp = _open_raw(filesystem, path)
+        for record in xanalytics.bsonarchive.read_archive(
+                fp, index, time_range=time_range):
+            yield record
 
 
 @filter_map
@@ -139,29 +746,215 @@ def read_data(filesystem,
               only_gz=False,
               format="text",
               csv_delimiter="\t",
-              csv_header=False):
+              csv_header=False,
+              processes=None,
+              ordered=True,
+              batched=False,
+              time_range=None,
+              where=None):
     '''Takes a pyfs containing log files. Returns an iterator of all
     lines in all files.
 
     Optional: Skip non-.gz files.
     Optional: Format can be text, JSON, or BSON, in which case, we'll decode.
+    Optional: Decompress and split lines in `processes` worker
+    processes. If not `ordered`, files come back in the order they
+    finish decompressing. If `batched` (text or JSON), we return lists
+    of lines or events rather than lines or events, which saves a
+    generator step per line.
+    Optional: `time_range` is a (min, max) pair of time strings. For
+    BSON archives with an index, we skip blocks outside of it. For
+    text, we skip files outside of it, if the directory has a catalog
+    (see `build_catalog`). Either way, we may still return some
+    events outside of it, so follow with a time filter (e.g.
+    `xevents.date_between`) if that matters.
+    Optional: `where` is a predicate on catalog entries (see
+    `file_filter`). Files it rejects are skipped. As with
+    `time_range`, this only skips files, so filter the events too.
+
+    To keep reading as new data arrives, see `tail_data`.
     '''
     filesystem = _to_filesystem(filesystem)
     if format == "bson":
-        warnings.warn("Untested code path")
-        return _read_bson_data(filesystem, directory)
+        return _read_bson_data(filesystem, directory, only_gz, time_range)
 
-    text_data = _read_text_data(filesystem, directory, only_gz)
+    if time_range is not None:
+        in_range = file_filter(time_range=time_range)
+        if where is None:
+            where = in_range
+        else:
+            selected = where
+
+            def where(entry):
+                return in_range(entry) and selected(entry)
+
+    text_data = None
+    batches = None
+    if processes:
+        batches = _read_text_data_parallel(filesystem,
+                                           directory,
+                                           only_gz,
+                                           processes,
+                                           ordered,
+                                           where=where)
+    else:
+        text_data = _read_text_data(filesystem, directory, only_gz, where)
+        # Only batch lines if someone wants batches
+        if format == "json" or (batched and format == "text"):
+            batches = batch(text_data)
+
+    if format == "json":
+        if batched:
+            return text_to_json_batches(batches)
+        return unbatch(text_to_json_batches(batches))
+    elif batched and format == "text":
+        return batches
+
+    if text_data is None:
+        text_data = unbatch(batches)
     if format == "text":
         return text_data
-    elif format == "json":
-        return text_to_json(text_data)
     elif format == "csv":
         return text_to_csv(text_data, csv_delimiter, csv_header)
     else:
         raise AttributeError("Unknown format: ", format)
 
 
+def _save_offsets(checkpoint, offsets):
+    '''
+    Helper: Atomically write tail_data's offsets.
+    '''
+    temporary = checkpoint + ".tmp"
+    fp = open(temporary, "w")
+    json.dump(offsets, fp)
+    fp.close()
+    os.rename(temporary, checkpoint)
+
+
+def tail_data(filesystem,
+              directory=".",
+              only_gz=False,
+              checkpoint=None,
+              interval=60,
+              settle=60,
+              stop=None):
+    '''
+    Yield the lines of all the files in a directory, and then keep
+    going: as new files arrive, or files are appended to, yield their
+    new lines too. This lets a long-running pipeline process logs as
+    they come in, rather than rescanning everything every day.
+
+    We watch the directory (see `gzipfs.watch`) for files being
+    closed after writing or moved into place. Where that isn't
+    supported, or events are lost, we also rescan every `interval`
+    seconds; a file we didn't see closed is only read once it hasn't
+    changed for `settle` seconds, so we don't read half-written files.
+
+    If `checkpoint` (a path on local disk) is given, the number of
+    lines read from each file is saved there as we go, so a restarted
+    pipeline picks up where it left off. A file is replaced, rather
+    than appended to, if it shrinks, and is then read from the start.
+
+    This runs until `stop` (a threading.Event) is set, or the
+    generator is closed. Either way, the checkpoint is saved on the
+    way out, so lines already returned aren't returned again.
+
+    >>> import itertools, shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> _ = open(directory + "/log", "w").write("a\\nb\\nc\\n")
+    >>> checkpoint = directory + ".offsets"
+    >>> lines = tail_data(fs.osfs.OSFS(directory), checkpoint=checkpoint,
+    ...                   settle=0)
+    >>> list(itertools.islice(lines, 2))
+    ['a\\n', 'b\\n']
+    >>> lines.close()
+    >>> json.load(open(checkpoint))['log']['lines']
+    2
+    >>> lines = tail_data(fs.osfs.OSFS(directory), checkpoint=checkpoint,
+    ...                   settle=0)
+    >>> lines.next()
+    'c\\n'
+    >>> lines.close()
+    >>> shutil.rmtree(directory)
+    >>> os.unlink(checkpoint)
+    '''
+    filesystem = _to_filesystem(filesystem)
+    offsets = {}
+    if checkpoint and os.path.exists(checkpoint):
+        offsets = json.load(open(checkpoint))
+    ready = Queue.Queue()
+
+    def changed(event):
+        if isinstance(event, MOVED_DST) or \
+           (isinstance(event, MODIFIED) and event.closed):
+            ready.put(basename(event.path))
+
+    try:
+        filesystem.add_watcher(changed,
+                               directory,
+                               (CREATED, MODIFIED, MOVED_DST),
+                               recursive=False)
+        watching = True
+    except (AttributeError, UnsupportedError):
+        watching = False
+
+    closed = set()  # Files we saw closed since we last read them
+    try:
+        while not (stop and stop.is_set()):
+            for f in get_files(filesystem, directory, only_gz):
+                path = directory + "/" + f
+                info = filesystem.getinfo(path)
+                (size, modified) = (info.get('size'),
+                                    str(info.get('modified_time')))
+                offset = offsets.get(f)
+                if offset and offset['complete'] and \
+                   (offset['size'], offset['modified']) == (size, modified):
+                    continue  # Nothing new
+                if f not in closed:
+                    age = datetime.datetime.now() - info['modified_time']
+                    if age < datetime.timedelta(seconds=settle):
+                        continue  # Might still be being written
+                closed.discard(f)
+                skip = 0
+                if offset and size >= offset['size']:
+                    skip = offset['lines']
+                offset = {'size': size,
+                          'modified': modified,
+                          'lines': skip,
+                          'complete': False}
+                offsets[f] = offset
+                for (number, line) in enumerate(filesystem.open(path)):
+                    if number < skip:
+                        continue
+                    # Counted before we yield, since we may not get
+                    # control back if we're closed.
+                    offset['lines'] = number + 1
+                    yield line.encode('ascii', 'ignore')
+                    if checkpoint and offset['lines'] % 10000 == 0:
+                        _save_offsets(checkpoint, offsets)
+                offset['complete'] = True
+                if checkpoint:
+                    _save_offsets(checkpoint, offsets)
+            try:
+                closed.add(ready.get(timeout=interval))
+                while not ready.empty():
+                    closed.add(ready.get())
+            except Queue.Empty:
+                pass
+    finally:
+        if watching:
+            filesystem.del_watcher(changed)
+        if checkpoint:
+            _save_offsets(checkpoint, offsets)
+
+
+# We've truncated lines to random lengths in the past. Lines of these
+# lengths get dropped.
+_TRUNCATED_LENGTHS = frozenset(range(32000, 33000) +
+                               range(9980, 10001) +
+                               range(2039, 2044))
+
+
 @filter_map
 def text_to_json(line, clever=False):
     '''Decode lines to JSON. If a line is truncated, this will drop the line.
@@ -198,12 +991,7 @@ def text_to_json(line, clever=False):
             "detecting a non-JSON line of some form"
         os.exit(-1)
 
-    # We've truncated lines to random lengths in the past...
-    if len(line) in range(32000, 33000):
-        return None
-    elif len(line) in range(9980, 10001):
-        return None
-    elif len(line) in range(2039, 2044):
+    if len(line) in _TRUNCATED_LENGTHS:
         return None
     try:
         line = json.loads(line)
@@ -213,6 +1001,70 @@ def text_to_json(line, clever=False):
         return None
 
 
+def text_to_json_batches(batches):
+    '''Decode batches (lists) of lines to JSON. Yields lists of
+    events. Lines are dropped with the same rules as text_to_json
+    (without `clever`).
+
+    This is much faster than text_to_json. We skip a generator step
+    per line, and we decode the whole batch with one call to the
+    JSON library. If that fails, we fall back to decoding line by
+    line.
+
+    >>> data = [['{"a":1}\\n', 'junk\\n', '{"b":2}'], ['["c"]']]
+    >>> list(text_to_json_batches(data))
+    [[{u'a': 1}, {u'b': 2}]]
+    '''
+    for batch in batches:
+        lines = []
+        for line in batch:
+            line = line.strip()
+            if line[:1] == '{' and len(line) not in _TRUNCATED_LENGTHS:
+                lines.append(line)
+        try:
+            events = _json_loads('[' + ','.join(lines) + ']')
+            if len(events) != len(lines):  # e.g. '{...},{...}' on one line
+                raise ValueError("Line count mismatch")
+        except ValueError:
+            events = []
+            for line in lines:
+                try:
+                    events.append(_json_loads(line))
+                except ValueError:
+                    print >>sys.stderr, "Bad JSON line:", line[:100], \
+                        len(line)
+        events = [event for event in events if event]
+        if events:
+            yield events
+
+
+def batch(data, size=1000):
+    '''
+    Group a stream of items into lists of (up to) `size` items.
+
+    >>> list(batch(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    '''
+    data = iter(data)
+    while True:
+        items = list(itertools.islice(data, size))
+        if not items:
+            break
+        yield items
+
+
+def unbatch(batches):
+    '''
+    Turn a stream of lists of items back into a stream of items.
+
+    >>> list(unbatch([[0, 1], [2, 3], [4]]))
+    [0, 1, 2, 3, 4]
+    '''
+    for items in batches:
+        for item in items:
+            yield item
+
+
 def json_to_text(data):
     ''' Convert JSON back to text, for dumping to processed file
     '''
@@ -220,29 +1072,329 @@ def json_to_text(data):
         yield json.dumps(line) + '\n'
 
 
-_data_part = 0
-_data_item = 0
+def _part_extension(format, codec):
+    '''
+    Helper: The file extension for a part written by `DataWriter`.
+
+    >>> _part_extension("text", "gzip")
+    '.gz'
+    >>> _part_extension("bson", "zstd")
+    '.bson.zst'
+    '''
+    extension = codecs.EXTENSIONS[codec]
+    if format == "bson":
+        extension = ".bson" + extension
+    return extension
+
+
+def _write_part(path, lines, format, codec, level):
+    '''
+    Helper: Compress and write out one part for `DataWriter`. This
+    runs in a worker thread or process. We write to a temporary file
+    and rename it, so readers never see half-written parts.
+    '''
+    (directory, filename) = os.path.split(path)
+    temporary = os.path.join(directory, "." + filename + ".tmp")
+    if format == "bson":
+        index_path = xanalytics.bsonarchive.index_path(path)
+        index_temporary = xanalytics.bsonarchive.index_path(temporary)
+        writer = xanalytics.bsonarchive.BSONArchiveWriter(
+            open(temporary, "wb"),
+            open(index_temporary, "w"),
+            codec=codec,
+            level=level)
+        for line in lines:
+            writer.write(line)
+        writer.close()
+        os.rename(index_temporary, index_path)
+    else:
+        fp = open(temporary, "wb")
+        fp.write(codecs.compress("".join(lines), codec, level))
+        fp.close()
+    os.rename(temporary, path)
+    return path
+
+
+class DataWriter(object):
+    '''
+    Write a stream of lines (or encoded BSON records) into numbered,
+    compressed part files in a directory, as `save_data` does.
+
+    A new part is started every `max_items` lines (by default, the
+    max-file-size setting) or, if `max_bytes` is set, once a part
+    holds that many bytes. Full parts are compressed on a pool of
+    `threads` threads (zlib releases the GIL), or of `processes`
+    processes if that is given, while we keep reading the stream.
+
+    `codec` is 'gzip', 'zstd', 'lz4', or None; see `gzipfs.codecs`.
+    `level` is the compression level for the codec.
+
+    Parts are numbered after any parts already in the directory, so
+    several writers can fill the same directory one after another.
+
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> with DataWriter(directory, max_items=2) as writer:
+    ...     for line in ["a\\n", "b\\n", "c\\n"]:
+    ...         writer.write(line)
+    >>> sorted(os.listdir(directory))
+    ['part0.gz', 'part1.gz']
+    >>> list(read_data(GZIPFS(directory)))
+    ['a\\n', 'b\\n', 'c\\n']
+    >>> shutil.rmtree(directory)
+    '''
+    def __init__(self,
+                 directory,
+                 format="text",
+                 codec="gzip",
+                 level=6,
+                 max_items=None,
+                 max_bytes=None,
+                 threads=None,
+                 processes=None):
+        codecs.check(codec)
+        if max_items is None:
+            max_items = int(xanalytics.settings.settings.get('max-file-size',
+                                                             20000))
+        if processes:
+            self.pool = multiprocessing.Pool(processes)
+            workers = processes
+        else:
+            workers = threads or multiprocessing.cpu_count()
+            self.pool = multiprocessing.pool.ThreadPool(workers)
+        self.directory = directory
+        self.format = format
+        self.codec = codec
+        self.level = level
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_pending = workers * 2
+        self.extension = _part_extension(format, codec)
+        self.part = self._next_part()
+        self.lines = []
+        self.size = 0
+        self.pending = collections.deque()
+        self.paths = []
+
+    def _next_part(self):
+        '''
+        Helper: Find the first free part number in the directory.
+        '''
+        parts = [-1]
+        for filename in os.listdir(self.directory):
+            match = re.match(r"part(\d+)\.", filename)
+            if match:
+                parts.append(int(match.group(1)))
+        return max(parts) + 1
+
+    def _wait(self, pending):
+        while len(self.pending) > pending:
+            self.paths.append(self.pending.popleft().get())
+
+    def flush(self):
+        '''
+        Hand the current part off to be compressed and written.
+        '''
+        if not self.lines:
+            return
+        path = os.path.join(self.directory,
+                            "part{part}{ext}".format(part=self.part,
+                                                     ext=self.extension))
+        self._wait(self.max_pending - 1)
+        self.pending.append(self.pool.apply_async(
+            _write_part,
+            (path, self.lines, self.format, self.codec, self.level)))
+        self.part = self.part + 1
+        self.lines = []
+        self.size = 0
+
+    def write(self, line):
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        self.lines.append(line)
+        self.size = self.size + len(line)
+        if len(self.lines) >= self.max_items or \
+           (self.max_bytes and self.size >= self.max_bytes):
+            self.flush()
+
+    def close(self):
+        '''
+        Write out the last part, and wait for all parts to be
+        written. Returns the paths of the parts, in order.
+        '''
+        try:
+            self.flush()
+            self._wait(0)
+        finally:
+            self.pool.close()
+            self.pool.join()
+        return self.paths
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.terminate()
+            self.pool.join()
 
 
-def save_data(data, directory):
+def save_data(data,
+              directory,
+              format="text",
+              codec="gzip",
+              level=6,
+              max_items=None,
+              max_bytes=None,
+              threads=None,
+              processes=None):
     '''
     Write data back to the directory specified. Data is dumped into
     individual files, each a maximum of 20,000 events long (by
-    default, overridable in settings).
+    default, overridable in settings, or with `max_items` and
+    `max_bytes`). Files are compressed in parallel; see `DataWriter`.
+
+    With format="bson", data should be encoded BSON (e.g. from
+    `encode_to_bson`). Each file is then an indexed BSON archive (see
+    `bsonarchive`), which `read_data(format="bson")` can read back.
+
+    Returns the paths of the files written.
     '''
-    global _data_part, _data_item
-    fout = None
-    max_file_length = int(settings.settings.get('max-file-size', 20000))
-    for line in data:
-        if _data_item % 20000 == 0:
-            if fout:
-                fout.close()
-            filename = "{dir}/part{part}.gz".format(dir=directory,
-                                                    part=_data_part)
-            fout = gzip.open(filename, "w")
-            _data_part = _data_part + 1
-        fout.write(line)
-        _data_item = _data_item + 1
+    writer = DataWriter(directory,
+                        format=format,
+                        codec=codec,
+                        level=level,
+                        max_items=max_items,
+                        max_bytes=max_bytes,
+                        threads=threads,
+                        processes=processes)
+    with writer:
+        for line in data:
+            writer.write(line)
+    return writer.paths
+
+
+class ShardedWriter(object):
+    '''
+    Write lines into many shard files in a directory (e.g. one per
+    `short_hash` of the username), while keeping few files open and
+    making few, large writes.
+
+    Lines are buffered in memory per shard. A shard is written out
+    once it holds `block_size` bytes, or, if all the buffers together
+    pass `max_bytes`, the largest shards are written out until they
+    are down to half of that. Each write is one complete gzip member
+    (or zstd/lz4 frame) appended to the shard's file, so files are
+    always valid, and shards can be added to by later runs, or by
+    several writers one after another. At most `max_open` files are
+    open at once; the least recently used is closed to make room.
+
+    Shard files are named `name.format(shard=shard)`.
+
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> with ShardedWriter(directory, max_open=1, block_size=4) as writer:
+    ...     for line in ["a1\\n", "b1\\n", "a2\\n", "c1\\n"]:
+    ...         writer.write(line[0], line)
+    >>> sorted(os.listdir(directory))
+    ['a.gz', 'b.gz', 'c.gz']
+    >>> list(GZIPFS(directory).open("a.gz"))
+    ['a1\\n', 'a2\\n']
+    >>> shutil.rmtree(directory)
+    '''
+    def __init__(self,
+                 directory,
+                 name=None,
+                 codec="gzip",
+                 level=6,
+                 max_open=64,
+                 block_size=1024 * 1024,
+                 max_bytes=256 * 1024 * 1024):
+        codecs.check(codec)
+        if name is None:
+            name = "{shard}" + codecs.EXTENSIONS[codec]
+        self.directory = directory
+        self.name = name
+        self.codec = codec
+        self.level = level
+        self.max_open = max_open
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.buffers = collections.defaultdict(list)
+        self.sizes = collections.defaultdict(int)
+        self.size = 0
+        self.handles = collections.OrderedDict()  # Least recent first
+        self.shards = set()
+
+    def _handle(self, shard):
+        '''
+        Helper: Return an open file for a shard, closing the least
+        recently used file if we're at our limit.
+        '''
+        if shard in self.handles:
+            fp = self.handles.pop(shard)
+        else:
+            while len(self.handles) >= self.max_open:
+                self.handles.popitem(last=False)[1].close()
+            path = os.path.join(self.directory,
+                                self.name.format(shard=shard))
+            fp = open(path, "ab")
+        self.handles[shard] = fp
+        return fp
+
+    def flush(self, shard=None):
+        '''
+        Write out the buffer for one shard (or, by default, all of
+        them).
+        '''
+        if shard is None:
+            for shard in sorted(self.buffers):
+                self.flush(shard)
+            return
+        lines = self.buffers.pop(shard, None)
+        if not lines:
+            return
+        data = "".join(lines)
+        if self.codec is not None:
+            data = codecs.compress(data, self.codec, self.level)
+        self._handle(shard).write(data)
+        self.size = self.size - self.sizes.pop(shard)
+        self.shards.add(shard)
+
+    def write(self, shard, line):
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        self.buffers[shard].append(line)
+        self.sizes[shard] = self.sizes[shard] + len(line)
+        self.size = self.size + len(line)
+        if self.sizes[shard] >= self.block_size:
+            self.flush(shard)
+        elif self.size >= self.max_bytes:
+            largest = sorted(self.sizes, key=self.sizes.get, reverse=True)
+            for shard in largest:
+                if self.size <= self.max_bytes / 2:
+                    break
+                self.flush(shard)
+
+    def close(self):
+        '''
+        Write out all the buffers, and close all files. Returns the
+        shards written.
+        '''
+        try:
+            self.flush()
+        finally:
+            while self.handles:
+                self.handles.popitem()[1].close()
+        return sorted(self.shards)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 def read_bson_file(filename):
@@ -254,8 +1406,6 @@ def read_bson_file(filename):
 
     Performance between cjson, simplejson, and other libraries is more
     mixed.
-
-    Untested since move from filename to fp and refactoring
     '''
     return _read_bson_file(gzip.open(filename))
 
@@ -269,7 +1419,66 @@ def encode_to_bson(data):
         yield BSON.encode(d)
 
 
-_hash_memory = dict()
+_MISSING = object()
+
+
+class BoundedCache(object):
+    '''
+    A dictionary which holds at most about `size` items, dropping the
+    least recently used first. It keeps two generations: new items go
+    into the current one, and items used from the old one are moved
+    up. When the current generation fills, the old one is dropped in
+    bulk. This is cheaper than tracking the exact order of use.
+
+    >>> cache = BoundedCache(2)
+    >>> cache["a"] = 1
+    >>> cache["b"] = 2
+    >>> cache["c"] = 3
+    >>> "a" in cache, "c" in cache
+    (True, True)
+    >>> cache["d"] = 4
+    >>> cache["e"] = 5
+    >>> "a" in cache
+    False
+    '''
+    def __init__(self, size=100000):
+        self.size = size
+        self.current = {}
+        self.old = {}
+
+    def __contains__(self, key):
+        return key in self.current or key in self.old
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self.current.get(key, _MISSING)
+        if value is _MISSING:
+            value = self.old.get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if len(self.current) >= self.size:
+            self.old = self.current
+            self.current = {}
+        self.current[key] = value
+
+    def __len__(self):
+        return len(self.current) + len(self.old)
+
+    def clear(self):
+        self.current = {}
+        self.old = {}
+
+
+_hash_memory = BoundedCache()
 
 
 def short_hash(string, length=3, memoize=False):
@@ -280,6 +1489,10 @@ def short_hash(string, length=3, memoize=False):
     This is helpful if we want to shard data. This is not helpful if
     we want to avoid collisions. The hash is **short**.
 
+    This is an md5 hash, kept for files sharded by earlier runs. New
+    code should use `Sharder`, which is faster. If
+    `memoize`, hashes are cached in a `BoundedCache`.
+
     >>> short_hash("Alice") != short_hash("Bob")
     True
     >>> short_hash("Eve") == short_hash("Eve")
@@ -293,22 +1506,22 @@ def short_hash(string, length=3, memoize=False):
     >>> len(short_hash("Mallet")) == 3
     True
     '''
-    global _hash_memory
     if memoize:
-        if string in _hash_memory:
-            return _hash_memory[string]
+        h = _hash_memory.get(string)
+        if h is not None:
+            return h[0:length]
     m = md5.new()
     m.update(string)
-    h = m.hexdigest()[0:length]
+    h = m.hexdigest()
     if memoize:
-        _hash_memory[string] = h
-    return h
+        _hash_memory[string] = h  # Whole, so any length can be used
+    return h[0:length]
 
 
 def list_short_hashes(length):
     '''
     A generator of all hashes of length `length` (as would be
-    generated by short_hash)
+    generated by short_hash, or named by `Sharder(16 ** length)`)
 
     Hashes are of the form we expect
     >>> "aa" in list(list_short_hashes(2))
@@ -323,12 +1536,169 @@ def list_short_hashes(length):
     True
     >>> short_hash("Hello", 3) in list(list_short_hashes(3))
     True
+    >>> list(list_short_hashes(2)) == Sharder(16 ** 2).names()
+    True
     '''
     generator = ("".join(x)
                  for x in itertools.product("0123456789abcdef", repeat=length))
     return generator
 
 
+def hash_key(key):
+    '''
+    A fast 32-bit hash of a string, for sharding (not for security):
+    crc32, which runs in C.
+
+    >>> hash_key("Alice") == hash_key(u"Alice")
+    True
+    '''
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return zlib.crc32(key) & 0xffffffff
+
+
+def jump_hash(h, buckets):
+    '''
+    Jump consistent hash (Lamping and Veach, 2014): map a hash to one
+    of `buckets` buckets, such that going from n to n + 1 buckets only
+    moves 1/(n + 1) of the keys (all of them to the new bucket).
+
+    `h` may also be a numpy array of hashes, which are all mapped at
+    once.
+
+    >>> moved = [h for h in range(1000)
+    ...          if jump_hash(h, 10) != jump_hash(h, 11)]
+    >>> all(jump_hash(h, 11) == 10 for h in moved)
+    True
+    >>> hashes = numpy.arange(5, dtype=numpy.uint64)
+    >>> jump_hash(hashes, 11).tolist() == [jump_hash(h, 11) for h in range(5)]
+    True
+    '''
+    if numpy is not None and isinstance(h, numpy.ndarray):
+        return _jump_hash_array(h, buckets)
+    b = -1
+    j = 0
+    while j < buckets:
+        b = j
+        h = (h * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (2147483648.0 / ((h >> 33) + 1)))
+    return b
+
+
+def _jump_hash_array(h, buckets):
+    '''
+    Helper: jump_hash over a numpy array. Each step of the loop runs
+    on all the hashes which haven't settled yet.
+    '''
+    h = h.astype(numpy.uint64)
+    b = numpy.zeros(len(h), dtype=numpy.int64)
+    j = numpy.zeros(len(h), dtype=numpy.int64)
+    active = numpy.arange(len(h))
+    with numpy.errstate(over='ignore'):
+        while len(active):
+            b[active] = j[active]
+            h[active] = h[active] * numpy.uint64(2862933555777941757) + \
+                numpy.uint64(1)
+            j[active] = ((b[active] + 1) *
+                         (2147483648.0 /
+                          ((h[active] >> numpy.uint64(33)) + 1)
+                          .astype(numpy.float64))).astype(numpy.int64)
+            active = active[j[active] < buckets]
+    return b
+
+
+class Sharder(object):
+    '''
+    Map keys (e.g. usernames) to `shards` shard IDs, 0 to shards - 1.
+
+    By default, the ID is a crc32 hash modulo the number of shards.
+    With `consistent` hashing, changing the number of shards moves as
+    few keys as possible (see `jump_hash`), but each new key costs a
+    few times more; `batch` makes up for it with numpy. With
+    `method="md5"`, keys go where `short_hash` put them, for adding
+    to data sharded by earlier runs; `shards` must then be a power of
+    16.
+
+    Results of md5 and consistent hashing are cached in a
+    `BoundedCache` of `cache_size` keys. Plain crc32 is cheaper to
+    recompute than to look up, so it isn't cached.
+
+    Shards are named as hex numbers (`name`), the same way as
+    `short_hash`, so `list_short_hashes` and `aws.get_hashed_files`
+    work with either method when there are 16 ** length shards.
+
+    >>> sharder = Sharder(4096, consistent=True)
+    >>> 0 <= sharder("Alice") < 4096
+    True
+    >>> sharder.batch(["Alice", "Bob", "Alice"])[0] == sharder("Alice")
+    True
+    >>> len(sharder.name(sharder("Alice")))
+    3
+    >>> legacy = Sharder(4096, method="md5")
+    >>> legacy.name(legacy("Alice")) == short_hash("Alice")
+    True
+    '''
+    def __init__(self, shards, consistent=False, method="crc32",
+                 cache_size=100000):
+        if method == "md5":
+            self.length = len("%x" % (shards - 1))
+            if shards != 16 ** self.length:
+                raise ValueError("md5 sharding needs a power of 16 shards")
+        elif method != "crc32":
+            raise ValueError("Unknown sharding method: " + repr(method))
+        self.shards = shards
+        self.consistent = consistent
+        self.method = method
+        self.cache = BoundedCache(cache_size) \
+            if method == "md5" or consistent else None
+        self.width = max(len("%x" % (shards - 1)), 1)
+
+    def __call__(self, key):
+        if self.cache is None:
+            # hash_key, inlined: this is the hot path
+            if isinstance(key, unicode):
+                key = key.encode('utf-8')
+            return (zlib.crc32(key) & 0xffffffff) % self.shards
+        shard = self.cache.get(key)
+        if shard is None:
+            if self.method == "md5":
+                shard = int(short_hash(key, self.length), 16)
+            else:
+                shard = jump_hash(hash_key(key), self.shards)
+            self.cache[key] = shard
+        return shard
+
+    def batch(self, keys):
+        '''
+        Return the shard IDs of a list of keys. Each distinct key is
+        only hashed once, and with numpy, they are all mapped to
+        shards at once.
+        '''
+        keys = list(keys)
+        unique = list(set(keys))
+        if numpy is not None and self.method == "crc32":
+            hashes = numpy.fromiter((hash_key(key) for key in unique),
+                                    dtype=numpy.uint64,
+                                    count=len(unique))
+            if self.consistent:
+                hashes = jump_hash(hashes, self.shards)
+            else:
+                hashes = hashes % numpy.uint64(self.shards)
+            shards = dict(zip(unique, hashes.tolist()))
+        else:
+            shards = dict((key, self(key)) for key in unique)
+        return [shards[key] for key in keys]
+
+    def name(self, shard):
+        '''
+        The name of a shard: its ID as fixed-width hex.
+        '''
+        return "%0*x" % (self.width, shard)
+
+    def names(self):
+        return [self.name(shard) for shard in range(self.shards)]
+
+
 def filter_data(data, filter):
     '''
     Apply a function 'filter' to all elements in the data
@@ -363,10 +1733,7 @@ def field_set(data, field):
     '''
     Return a set of unique items in field
     '''
-    us = set()
-    for event in data:
-        us.add(__select_field(event, field))
-    return us
+    return set(itertools.imap(field_accessor(field), data))
 
 
 def dbic(data, label):
@@ -380,6 +1747,79 @@ def dbic(data, label):
     print label, cnt
 
 
+_field_accessors = dict()
+
+
+def field_accessor(field):
+    '''
+    Compile a field definition (e.g. "event:element") into a function
+    which does the hierarchical query on an event, returning None if
+    the field is missing. The definition is only parsed once, so use
+    this in loops over events.
+
+    >>> get = field_accessor("event:element")
+    >>> get({"event": {"element": 5}})
+    5
+    >>> get({"event": "a string"}) is None
+    True
+    >>> get({}) is None
+    True
+    '''
+    if field in _field_accessors:
+        return _field_accessors[field]
+    keys = tuple(field.split(":"))  # Pick out the hierarchy
+    if len(keys) == 1:
+        key = keys[0]
+
+        def accessor(event):
+            try:
+                return event[key]
+            except (KeyError, TypeError, IndexError):
+                return None
+    else:
+        def accessor(event):
+            try:
+                for key in keys:
+                    event = event[key]
+                return event
+            except (KeyError, TypeError, IndexError):
+                return None
+    _field_accessors[field] = accessor
+    return accessor
+
+
+def field_matcher(field_spec):
+    '''
+    Compile a field spec, mapping field names to lists of possible
+    values, into a function which tells whether an event matches all
+    of the fields. Values are looked up in a set, and we stop at the
+    first field which doesn't match.
+
+    >>> matches = field_matcher({"username": ["jack", "jill"]})
+    >>> matches({"username": "jill"}), matches({"username": "bob"})
+    (True, False)
+    '''
+    tests = []
+    for field in field_spec:
+        values = field_spec[field]
+        if not isinstance(values, basestring):
+            try:
+                values = frozenset(values)
+            except TypeError:  # Unhashable values
+                values = list(values)
+        tests.append((field_accessor(field), values))
+
+    def matches(event):
+        for (accessor, values) in tests:
+            try:
+                if accessor(event) not in values:
+                    return False
+            except TypeError:  # Unhashable field value
+                return False
+        return True
+    return matches
+
+
 def __select_field(event, field):
     '''
     Takes a field definition and a dictionary. Does a hierarchical query.
@@ -388,77 +1828,327 @@ def __select_field(event, field):
       event['event']['element']
     except KeyError:
       return None
+
+    In loops, use `field_accessor` instead.
     '''
-    for key in field.split(":"):  # Pick out the hierarchy
-        if key not in event:
-            return None
-        event = event[key]
-    return event
+    return field_accessor(field)(event)
 
 
 def sort_events(data, fields):
     '''
     Sort data. Warning: In-memory. Not iterable. Only works for small datasets
     '''
-    def event_cmp(d1, d2):
-        for field in fields:
-            c = cmp(__select_field(d1, field), __select_field(d2, field))
-            if c != 0:
-                return c
-        return 0
-    return sorted(list(data), cmp=event_cmp)
+    accessors = [field_accessor(field) for field in fields]
+    return sorted(data,
+                  key=lambda d: tuple(accessor(d) for accessor in accessors))
 
 
 def select_fields(data, fields):
     '''
     Filter data down to a subset of fields. Also, flatten (should be a
     param in the future whether to do this.
+
+    >>> list(select_fields([{"a": {"b": 1}, "c": 2}], ["a:b", "d"]))
+    [{'a:b': 1, 'd': None}]
     '''
+    accessors = [(field, field_accessor(field)) for field in fields]
     for d in data:
-        d2 = {}
-        for field in fields:
-            d2[field] = __select_field(d, field)
-        yield d2
+        yield dict((field, accessor(d)) for (field, accessor) in accessors)
+
+
+def _trie_pattern(strings):
+    '''
+    Helper: A regular expression matching any of `strings`, shaped as
+    a trie, so shared prefixes are only tried once. This is several
+    orders of magnitude faster than a plain alternation for thousands
+    of strings. Where one string is a prefix of another, we match the
+    longest.
+
+    >>> _trie_pattern(["bob", "bobby", "al"])
+    '(?:al|bob(?:by)?)'
+    '''
+    trie = {}
+    for string in strings:
+        node = trie
+        for character in string:
+            node = node.setdefault(character, {})
+        node[''] = True
+
+    def pattern(node):
+        branches = [re.escape(character) + pattern(child)
+                    for (character, child) in sorted(node.items())
+                    if character != '']
+        if not branches:
+            return ''
+        if len(branches) == 1:
+            body = branches[0]
+        else:
+            body = "(?:" + "|".join(branches) + ")"
+        if '' in node:
+            # Optional: a string ends here, but longer ones go on.
+            single = len(body) == 1 or (len(body) == 2 and body[0] == '\\')
+            if not single:
+                body = "(?:" + body + ")"
+            body = body + "?"
+        return body
+
+    return pattern(trie)
+
+
+class MultiMatcher(object):
+    '''
+    Find which of many strings (e.g. thousands of usernames) appear in
+    a line of text, in one pass. This does the job of an Aho-Corasick
+    automaton: all matches are found, including overlapping ones, and
+    ones which are substrings of others. The automaton is a trie
+    compiled into a regular expression, so the scan runs in C.
+
+    >>> matcher = MultiMatcher(["bob", "bobby", "al"])
+    >>> sorted(matcher.search("bobby and sal"))
+    ['al', 'bob', 'bobby']
+    >>> matcher("alice"), matcher("carol")
+    (True, False)
+    '''
+    def __init__(self, strings):
+        self.strings = frozenset(s for s in strings if s)
+        self.lengths = sorted(set(len(s) for s in self.strings))
+        trie = _trie_pattern(self.strings)
+        self.any = re.compile(trie)
+        # Zero-width, so we find a match starting at every position
+        self.every = re.compile("(?=(" + trie + "))")
+
+    def __call__(self, line):
+        '''
+        Return True if any of the strings appear in the line.
+        '''
+        return bool(self.strings) and self.any.search(line) is not None
+
+    def search(self, line):
+        '''
+        Return the set of strings which appear in the line.
+        '''
+        found = set()
+        if not self(line):  # Most lines don't match; this is cheaper
+            return found
+        for match in self.every.finditer(line):
+            longest = match.group(1)
+            for length in self.lengths:
+                if length > len(longest):
+                    break
+                if longest[:length] in self.strings:
+                    found.add(longest[:length])
+        return found
+
+
+def _text_matcher(strings):
+    '''
+    Helper: Compile a string, a list of strings, or a compiled regular
+    expression into a test of whether it appears in a line of text.
+
+    >>> _text_matcher(["jack", "jill"])('{"username": "jill"}')
+    True
+    >>> _text_matcher("bob")('{"username": "jill"}')
+    False
+    '''
+    if hasattr(strings, "search"):
+        return lambda line: strings.search(line) is not None
+    if isinstance(strings, basestring):
+        return lambda line: strings in line
+    strings = list(set(strings))
+    if len(strings) == 1:
+        return _text_matcher(strings[0])
+    return MultiMatcher(strings)
 
 
 def select_in(data, string):
     '''
     Select data from _text_ (not JSON) where a string appears is in the data
+
+    `string` may also be a list of strings (any of which may appear) or
+    a compiled regular expression.
     '''
+    matches = _text_matcher(string)
     for d in data:
-        if string in d:
+        if matches(d):
             yield d
 
 
-def memoize(data, directory):
+def select_users(data, users, counts=None):
+    '''
+    Select lines of _text_ (not JSON) which mention any of `users`
+    anywhere (as with `user in line`), in one pass per line however
+    many users there are. Lines may be unicode or UTF-8 encoded.
+
+    If `counts` (a dictionary) is given, we add to it the number of
+    lines which mention each user.
+
+    >>> counts = {}
+    >>> list(select_users(['{"username": "al"}', '{"username": "bo"}',
+    ...                    '{"username": "al", "page": "/u/bo"}'],
+    ...                   ["al", "bo", "cy"],
+    ...                   counts))  # doctest: +NORMALIZE_WHITESPACE
+    ['{"username": "al"}', '{"username": "bo"}',
+     '{"username": "al", "page": "/u/bo"}']
+    >>> sorted(counts.items())
+    [('al', 2), ('bo', 2)]
+    '''
+    def encoded(user):
+        return user.encode('utf-8') if isinstance(user, unicode) else user
+
+    users = list(users)
+    names = dict((encoded(user), user) for user in users)
+    utf8_matcher = MultiMatcher(names)
+    unicode_matcher = MultiMatcher(
+        user if isinstance(user, unicode) else user.decode('utf-8')
+        for user in users)
+    for line in data:
+        if isinstance(line, unicode):
+            found = unicode_matcher.search(line)
+            found = [names[encoded(user)] for user in found]
+        else:
+            found = [names[user] for user in utf8_matcher.search(line)]
+        if not found:
+            continue
+        if counts is not None:
+            for user in found:
+                counts[user] = counts.get(user, 0) + 1
+        yield line
+
+
+def _json_strings(values):
     '''
-    UNTESTED/UNTESTED/UNTESTED
+    Helper: The ways each value may be written as a JSON string in a
+    log line. We include escaped slashes and escaped and raw unicode.
 
-    Check if the directory already has data. If so, read it in. Otherwise, dump
-    data to the directory and return it.
+    >>> sorted(_json_strings(["a/b"]))
+    [u'"a/b"', u'"a\\\\/b"']
+    '''
+    strings = set()
+    for value in values:
+        for text in [json.dumps(value), json.dumps(value, ensure_ascii=False)]:
+            text = unicode(text)
+            strings.add(text)
+            strings.add(text.replace(u"/", u"\\/"))
+    return strings
 
-    The current version reads/writes redundantly on the save operation, and
-    JSON decodes redundantly, so it's not very performant. This would be worth
-    fixing.
 
-    UNTESTED/UNTESTED/UNTESTED
+def _time_key_range(time_range):
+    '''
+    Helper: Turn a (min, max) pair of time strings, either of which
+    may be None, into time_key()s, for _in_time_range.
+    '''
+    return tuple(None if time is None else time_key(time)
+                 for time in time_range)
+
+
+def _in_time_range(time, time_range):
+    '''
+    Helper: Is a time string in a (min, max) range from
+    _time_key_range? Times we can't make sense of are not.
+
+    >>> _in_time_range("2014-01-02T05:00:00+02:00",
+    ...                _time_key_range(("2014-01-02T03:00:00", None)))
+    True
+    >>> _in_time_range("garbage", (None, None))
+    False
+    '''
+    try:
+        time = time_key(time)
+    except (ValueError, TypeError, OverflowError):
+        return False
+    (min_time, max_time) = time_range
+    return (min_time is None or time >= min_time) and \
+        (max_time is None or time <= max_time)
+
+
+def prefilter_text(data,
+                   event_types=None,
+                   courses=None,
+                   usernames=None,
+                   time_range=None):
+    '''
+    Cheaply drop lines of _text_ (not JSON) which can't be events of
+    one of the `event_types`, in one of the `courses`, by one of the
+    `usernames`, or in the (inclusive) `time_range`, without decoding
+    them. Any of these may be None, to not filter on it. Times are
+    compared by `time_key`, so time zones and formats don't matter.
+
+    This only looks for the values in the line, so some lines which
+    don't match may still come through (e.g. a course ID in a URL).
+    Follow with a check on the decoded events. `xevents.select_events`
+    does both.
+
+    >>> list(prefilter_text(['{"event_type": "play_video"}',
+    ...                      '{"event_type": "pause_video"}'],
+    ...                     event_types=["play_video"]))
+    ['{"event_type": "play_video"}']
+    '''
+    strings = [_json_strings(values)
+               for values in (event_types, courses, usernames)
+               if values is not None]
+    # Lines may be unicode, or UTF-8 encoded
+    unicode_tests = [_text_matcher(s) for s in strings]
+    utf8_tests = [_text_matcher([text.encode('utf-8') for text in s])
+                  for s in strings]
+    if time_range is not None:
+        time_range = _time_key_range(time_range)
+    for line in data:
+        tests = unicode_tests if isinstance(line, unicode) else utf8_tests
+        if not all(test(line) for test in tests):
+            continue
+        if time_range is not None:
+            times = _TIME_PATTERN.findall(line)
+            if times and not any(_in_time_range(t, time_range)
+                                 for t in times):
+                continue
+        yield line
+
+
+def _save_through(data, directory):
+    '''
+    Helper: Pass data through, saving it to the directory as we go.
+    If the stream isn't read to the end, the parts are removed again.
+    '''
+    writer = DataWriter(directory)
+    complete = False
+    try:
+        for line in data:
+            writer.write(line)
+            yield line
+        complete = True
+    finally:
+        paths = writer.close()
+        if not complete:
+            for path in paths:
+                os.remove(path)
+
+
+def memoize(data, directory):
+    '''
+    Check if the directory already has data. If so, read it in. Otherwise,
+    dump data to the directory as it streams through.
+
+    This only checks whether the directory has data, not whether it
+    came from the same source, so it is up to the caller to clear the
+    directory out when the source changes. `stagecache.cached_stage`
+    keys on the inputs and parameters instead, and is usually a better
+    choice.
     '''
     for f in os.listdir(directory):
         if not f.endswith(".gz"):
             continue
-        return read_data(directory)
+        return read_data(GZIPFS(directory))
 
-    save_data(data, directory)
-    return read_data(directory)
+    return _save_through(data, directory)
 
 
 def _read_bson_file(fp):
     while True:
-        l = f.read(4)
+        l = fp.read(4)
         if len(l) < 4:
             break
         length = struct.unpack('<i', l)
-        o = l + f.read(length[0]-4)
+        o = l + fp.read(length[0]-4)
         yield BSON.decode(BSON(o))
 
 
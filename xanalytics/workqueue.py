@@ -0,0 +1,653 @@
+'''
+Queues of work items (typically, names of log files), shared by a
+pool of workers. The same job can run on every core of one machine,
+or across a cluster, by switching the queue:
+
+* `SQSQueue` -- An Amazon SQS queue, for clusters.
+* `SQLiteQueue` -- A queue in an SQLite file. Any process on the
+  machine can open it, and it survives restarts.
+* `MultiprocessingQueue` -- A `LocalQueue` in a server process,
+  shared by the worker processes of one job.
+* `LocalQueue` -- In-process, for threads and tests.
+
+All of them follow SQS's model. A received message is hidden from
+other workers for `visibility_timeout` seconds. It is deleted once
+it has been processed. If the worker dies first, the message
+reappears for another worker. Each message also counts how many
+times it has been received.
+
+`process_queue` runs a function over every item in a queue, in one
+or more processes. It keeps the items it is working on hidden with a
+`Heartbeat`. It retries failed items, and sets aside poison items
+(ones which keep failing or crashing their worker). It also times
+each item:
+
+    >>> queue = LocalQueue(wait=0)
+    >>> queue.send(["1", "2", "x"])
+    3
+    >>> totals = process_queue(queue, int, max_attempts=2, verbose=False)
+    >>> totals['done'], totals['retried'], totals['poisoned']
+    (2, 1, 1)
+    >>> [body for (body, error) in queue.dead_letters()]
+    ['x']
+'''
+
+import Queue
+import collections
+import itertools
+import multiprocessing
+import multiprocessing.managers
+import multiprocessing.pool
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+try:
+    import boto.sqs
+except ImportError:
+    boto = None
+
+from xanalytics.settings import settings
+from xanalytics.streaming import batch
+
+# The most messages SQS will send, receive, or delete in one request
+SQS_BATCH_SIZE = 10
+
+# How often we try to send a batch before giving up
+_SEND_ATTEMPTS = 5
+
+
+class Message(object):
+    '''
+    A message from a queue other than SQS. It has the same interface
+    as boto's SQS messages.
+    '''
+    def __init__(self, id, body, receive_count=0):
+        self.id = id
+        self.body = body
+        self.receive_count = receive_count
+
+    def get_body(self):
+        return self.body
+
+
+class WorkQueue(object):
+    '''
+    The queue interface. Messages are strings.
+    '''
+    visibility_timeout = 300
+
+    def send(self, bodies):
+        '''
+        Add messages to the queue. Returns the number sent.
+        '''
+        raise NotImplementedError
+
+    def receive(self, count=SQS_BATCH_SIZE, wait=None):
+        '''
+        Receive up to `count` messages, waiting up to `wait` seconds
+        (by default, the queue's long poll time) for some to arrive.
+        Returns an empty list if there are none.
+        '''
+        raise NotImplementedError
+
+    def delete(self, messages):
+        '''
+        Remove messages which have been processed.
+        '''
+        raise NotImplementedError
+
+    def extend(self, messages, timeout=None):
+        '''
+        Keep messages hidden from other workers for another `timeout`
+        seconds (by default, the visibility timeout).
+        '''
+        raise NotImplementedError
+
+    def release(self, messages):
+        '''
+        Make messages visible again right away, so they can be retried.
+        '''
+        self.extend(messages, 0)
+
+    def poison(self, messages, error):
+        '''
+        Set aside messages which can't be processed. By default, we
+        log and delete them.
+        '''
+        for message in messages:
+            print "Poison message:", message.get_body(), error
+        self.delete(messages)
+
+
+def _sqs_queue(name=None):
+    sqs_conn = boto.sqs.connect_to_region(
+        "us-east-1",
+        aws_access_key_id=settings['edx-aws-access-key-id'],
+        aws_secret_access_key=settings['edx-aws-secret-key']
+    )
+    return sqs_conn.get_queue(name or settings["tracking-logs-queue"])
+
+
+class SQSQueue(WorkQueue):
+    '''
+    A batching client for an SQS queue (by default, the tracking logs
+    queue from settings). Each request to SQS is billed, so messages
+    are sent, received, and deleted up to ten at a time, and receives
+    long-poll (wait up to `wait` seconds for messages) rather than
+    returning empty-handed.
+
+    Poison messages are sent to `dead_letter` (another queue), if
+    given. A redrive policy on the SQS queue does the same job on the
+    SQS side.
+    '''
+    def __init__(self, queue=None, visibility_timeout=300, wait=20,
+                 threads=1, dead_letter=None):
+        if queue is None or isinstance(queue, basestring):
+            queue = _sqs_queue(queue)
+        self.queue = queue
+        self.pid = os.getpid()
+        self.visibility_timeout = visibility_timeout
+        self.wait = wait
+        self.threads = threads
+        self.dead_letter = dead_letter
+
+    def _connected(self):
+        '''
+        Helper: Return the boto queue. HTTP connections can't be
+        shared across a fork, so forked workers reconnect.
+        '''
+        if self.pid != os.getpid():
+            self.queue = _sqs_queue(self.queue.name)
+            self.pid = os.getpid()
+        return self.queue
+
+    def _send_batch(self, bodies):
+        '''
+        Helper: Send up to ten messages, retrying any which fail.
+        '''
+        queue = self._connected()
+        entries = [(str(i),
+                    queue.message_class(body=body).get_body_encoded(),
+                    0)
+                   for (i, body) in enumerate(bodies)]
+        for attempt in range(_SEND_ATTEMPTS):
+            failed = set(error['id']
+                         for error in queue.write_batch(entries).errors)
+            entries = [entry for entry in entries if entry[0] in failed]
+            if not entries:
+                return len(bodies)
+            time.sleep(2 ** attempt)
+        raise IOError("Could not send {count} messages to SQS".format(
+            count=len(entries)))
+
+    def send(self, bodies):
+        batches = batch(bodies, SQS_BATCH_SIZE)
+        if self.threads > 1:
+            pool = multiprocessing.pool.ThreadPool(self.threads)
+            try:
+                return sum(pool.imap_unordered(self._send_batch, batches))
+            finally:
+                pool.close()
+        return sum(self._send_batch(b) for b in batches)
+
+    def receive(self, count=SQS_BATCH_SIZE, wait=None):
+        messages = list(self._connected().get_messages(
+            num_messages=min(count, SQS_BATCH_SIZE),
+            visibility_timeout=self.visibility_timeout,
+            attributes='ApproximateReceiveCount',
+            wait_time_seconds=self.wait if wait is None else wait))
+        for message in messages:
+            message.receive_count = int(
+                message.attributes.get('ApproximateReceiveCount', 1))
+        return messages
+
+    def delete(self, messages):
+        for messages_batch in batch(messages, SQS_BATCH_SIZE):
+            self._connected().delete_message_batch(messages_batch)
+
+    def extend(self, messages, timeout=None):
+        if timeout is None:
+            timeout = self.visibility_timeout
+        for messages_batch in batch(messages, SQS_BATCH_SIZE):
+            self._connected().change_message_visibility_batch(
+                [(m, timeout) for m in messages_batch])
+
+    def poison(self, messages, error):
+        if self.dead_letter is None:
+            return super(SQSQueue, self).poison(messages, error)
+        self.dead_letter.send(m.get_body() for m in messages)
+        self.delete(messages)
+
+
+class LocalQueue(WorkQueue):
+    '''
+    An in-process queue, with the same visibility timeout semantics
+    as SQS: a received message is hidden from other receivers until
+    it is deleted or its timeout runs out. It is thread-safe, so it
+    can stand in for SQS in tests, or be shared by threads of one job.
+
+    >>> queue = LocalQueue(visibility_timeout=60)
+    >>> queue.send(["a", "b", "c"])
+    3
+    >>> [m.get_body() for m in queue.receive(2)]
+    ['a', 'b']
+    >>> [m.get_body() for m in queue.receive(2, wait=0)]
+    ['c']
+    >>> queue.receive(wait=0)
+    []
+    '''
+    def __init__(self, visibility_timeout=300, wait=20):
+        self.visibility_timeout = visibility_timeout
+        self.wait = wait
+        self.condition = threading.Condition()
+        self.ids = itertools.count()
+        self.messages = collections.OrderedDict()
+        self.visible_at = {}
+        self.dead = []
+
+    def send(self, bodies):
+        sent = 0
+        with self.condition:
+            for body in bodies:
+                message = Message(self.ids.next(), body)
+                self.messages[message.id] = message
+                self.visible_at[message.id] = 0
+                sent = sent + 1
+            self.condition.notify_all()
+        return sent
+
+    def receive(self, count=SQS_BATCH_SIZE, wait=None):
+        deadline = time.time() + (self.wait if wait is None else wait)
+        with self.condition:
+            while True:
+                now = time.time()
+                ready = [m for m in self.messages.values()
+                         if self.visible_at[m.id] <= now][:count]
+                if ready or now >= deadline:
+                    break
+                # Wake up for new messages, or when one times out.
+                wake = min([t for t in self.visible_at.values() if t > now] +
+                           [deadline])
+                self.condition.wait(wake - now)
+            for message in ready:
+                message.receive_count = message.receive_count + 1
+                self.visible_at[message.id] = now + self.visibility_timeout
+            return [Message(m.id, m.body, m.receive_count) for m in ready]
+
+    def delete(self, messages):
+        with self.condition:
+            for message in messages:
+                self.messages.pop(message.id, None)
+                self.visible_at.pop(message.id, None)
+
+    def extend(self, messages, timeout=None):
+        if timeout is None:
+            timeout = self.visibility_timeout
+        with self.condition:
+            for message in messages:
+                if message.id in self.visible_at:
+                    self.visible_at[message.id] = time.time() + timeout
+            self.condition.notify_all()
+
+    def poison(self, messages, error):
+        with self.condition:
+            for message in messages:
+                if self.messages.pop(message.id, None) is not None:
+                    self.visible_at.pop(message.id)
+                    self.dead.append((message.get_body(), error))
+
+    def dead_letters(self):
+        '''
+        Return (body, error) for each poison message.
+        '''
+        with self.condition:
+            return list(self.dead)
+
+    def count(self):
+        with self.condition:
+            return len(self.messages)
+
+
+class _QueueManager(multiprocessing.managers.BaseManager):
+    pass
+
+_QueueManager.register('LocalQueue', LocalQueue)
+
+
+class MultiprocessingQueue(WorkQueue):
+    '''
+    A `LocalQueue` run in a server process, so it can be shared by
+    worker processes on this machine (forked after it is made, as
+    `process_queue` does).
+    '''
+    def __init__(self, visibility_timeout=300, wait=20):
+        self.visibility_timeout = visibility_timeout
+        self.manager = _QueueManager()
+        self.manager.start()
+        self.queue = self.manager.LocalQueue(visibility_timeout, wait)
+
+    def send(self, bodies):
+        return self.queue.send(list(bodies))
+
+    def receive(self, count=SQS_BATCH_SIZE, wait=None):
+        return self.queue.receive(count, wait)
+
+    def delete(self, messages):
+        self.queue.delete(list(messages))
+
+    def extend(self, messages, timeout=None):
+        self.queue.extend(list(messages), timeout)
+
+    def poison(self, messages, error):
+        self.queue.poison(list(messages), error)
+
+    def dead_letters(self):
+        return self.queue.dead_letters()
+
+    def count(self):
+        return self.queue.count()
+
+
+class SQLiteQueue(WorkQueue):
+    '''
+    A queue in an SQLite database at `path`. It is safe to use from
+    many processes and threads on one machine (but not over NFS).
+    Receives poll the database every `poll` seconds while they wait.
+    '''
+    def __init__(self, path, visibility_timeout=300, wait=20, poll=0.5):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.wait = wait
+        self.poll = poll
+        self.local = threading.local()
+        self._execute('CREATE TABLE IF NOT EXISTS messages ('
+                      'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                      'body BLOB, '
+                      'visible_at REAL DEFAULT 0, '
+                      'receive_count INTEGER DEFAULT 0, '
+                      'dead INTEGER DEFAULT 0, '
+                      'error TEXT)')
+        self._execute('CREATE INDEX IF NOT EXISTS visible '
+                      'ON messages (dead, visible_at)')
+
+    def _connection(self):
+        '''
+        Helper: SQLite connections can't be shared between threads, or
+        across a fork, so each thread of each process gets its own.
+        '''
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.connection = sqlite3.connect(self.path,
+                                                    timeout=60,
+                                                    isolation_level=None)
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def _execute(self, sql, parameters=()):
+        return self._connection().execute(sql, parameters)
+
+    def _executemany(self, sql, rows):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany(sql, rows)
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def send(self, bodies):
+        sent = [0]
+
+        def rows():
+            for body in bodies:
+                if isinstance(body, unicode):
+                    body = body.encode('utf-8')
+                sent[0] = sent[0] + 1
+                yield (sqlite3.Binary(body),)
+        self._executemany('INSERT INTO messages (body) VALUES (?)', rows())
+        return sent[0]
+
+    def _take(self, count):
+        '''
+        Helper: Atomically receive up to `count` visible messages.
+        '''
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            rows = connection.execute(
+                'SELECT id, body, receive_count FROM messages '
+                'WHERE dead = 0 AND visible_at <= ? ORDER BY id LIMIT ?',
+                (now, count)).fetchall()
+            connection.executemany(
+                'UPDATE messages SET visible_at = ?, '
+                'receive_count = receive_count + 1 WHERE id = ?',
+                [(now + self.visibility_timeout, row[0]) for row in rows])
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return [Message(id, str(body), receive_count + 1)
+                for (id, body, receive_count) in rows]
+
+    def receive(self, count=SQS_BATCH_SIZE, wait=None):
+        deadline = time.time() + (self.wait if wait is None else wait)
+        while True:
+            messages = self._take(count)
+            if messages or time.time() >= deadline:
+                return messages
+            time.sleep(min(self.poll, max(deadline - time.time(), 0)))
+
+    def delete(self, messages):
+        self._executemany('DELETE FROM messages WHERE id = ?',
+                          [(m.id,) for m in messages])
+
+    def extend(self, messages, timeout=None):
+        if timeout is None:
+            timeout = self.visibility_timeout
+        self._executemany('UPDATE messages SET visible_at = ? WHERE id = ?',
+                          [(time.time() + timeout, m.id) for m in messages])
+
+    def poison(self, messages, error):
+        self._executemany('UPDATE messages SET dead = 1, error = ? '
+                          'WHERE id = ?',
+                          [(error, m.id) for m in messages])
+
+    def dead_letters(self):
+        '''
+        Return (body, error) for each poison message.
+        '''
+        return [(str(body), error) for (body, error) in self._execute(
+            'SELECT body, error FROM messages WHERE dead = 1 ORDER BY id')]
+
+    def count(self):
+        return self._execute(
+            'SELECT COUNT(*) FROM messages WHERE dead = 0').fetchone()[0]
+
+
+def open_queue(spec=None, **kwargs):
+    '''
+    Open a queue from a string, as given on a command line:
+    "sqlite:<path>", "sqs:<name>", or just the name of an SQS queue.
+    With no spec, we use the tracking logs queue in SQS.
+    '''
+    (kind, _, name) = (spec or "").partition(':')
+    if kind == 'sqlite':
+        return SQLiteQueue(name, **kwargs)
+    elif kind == 'sqs':
+        return SQSQueue(name or None, **kwargs)
+    return SQSQueue(spec, **kwargs)
+
+
+class Heartbeat(object):
+    '''
+    A background thread which keeps messages we're still working on
+    hidden from other consumers, by extending their visibility timeout
+    every `interval` seconds (by default, a third of the queue's
+    timeout). With this, a short timeout can be used, so work from a
+    crashed machine goes back to the queue quickly, while large files
+    still get as long as they need.
+    '''
+    def __init__(self, queue, interval=None):
+        self.queue = queue
+        self.interval = interval or queue.visibility_timeout / 3.
+        self.messages = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                messages = self.messages.values()
+            try:
+                if messages:
+                    self.queue.extend(messages)
+            except Exception, e:
+                print "Heartbeat failed:", e
+
+    def add(self, message):
+        with self.lock:
+            self.messages[id(message)] = message
+
+    def remove(self, message):
+        with self.lock:
+            self.messages.pop(id(message), None)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def _work(queue, process, max_attempts, verbose):
+    '''
+    Helper: Process items from the queue until it is empty. Returns
+    totals, as with process_queue.
+    '''
+    totals = collections.Counter(done=0, retried=0, poisoned=0, seconds=0.)
+    heartbeat = Heartbeat(queue)
+    try:
+        while True:
+            messages = queue.receive(1)
+            if not messages:
+                break
+            message = messages[0]
+            body = message.get_body()
+            if message.receive_count > max_attempts:
+                # Earlier attempts crashed or hung their workers.
+                queue.poison([message], "Gave up after {attempts} "
+                             "attempts".format(attempts=max_attempts))
+                totals['poisoned'] += 1
+                continue
+
+            heartbeat.add(message)
+            start = time.time()
+            try:
+                process(body)
+                status = "done"
+            except Exception:
+                error = traceback.format_exc()
+                if verbose:
+                    print error
+                if message.receive_count >= max_attempts:
+                    status = "poisoned"
+                else:
+                    status = "retried"
+            finally:
+                heartbeat.remove(message)
+            seconds = time.time() - start
+
+            if status == "done":
+                queue.delete([message])
+            elif status == "retried":
+                queue.release([message])
+            else:
+                queue.poison([message], error)
+            totals[status] += 1
+            totals['seconds'] += seconds
+            if verbose:
+                print "[{pid}] {body}: {status} in {seconds:.1f}s".format(
+                    pid=os.getpid(),
+                    body=body,
+                    status=status,
+                    seconds=seconds)
+    finally:
+        heartbeat.stop()
+    return totals
+
+
+def _worker(queue, process, max_attempts, verbose, results):
+    '''
+    Helper: Run _work in a worker process, and report the totals.
+    '''
+    totals = collections.Counter()
+    try:
+        totals = _work(queue, process, max_attempts, verbose)
+    except Exception:
+        traceback.print_exc()
+    results.put((os.getpid(), dict(totals)))
+
+
+def process_queue(queue,
+                  process,
+                  processes=1,
+                  max_attempts=3,
+                  verbose=True):
+    '''
+    Call `process(body)` for each message in `queue`, in `processes`
+    worker processes, until the queue is empty. Each message is
+    deleted once it has been processed.
+
+    If `process` raises an exception, the message goes back on the
+    queue to be retried, up to `max_attempts` times. After that, it is
+    poisoned (see `WorkQueue.poison`). So is a message which has been
+    received more than `max_attempts` times, since it has crashed or
+    hung its workers. Workers which crash are replaced (up to
+    `max_attempts` times per process).
+
+    Returns totals: items `done`, `retried`, and `poisoned`, the
+    `seconds` spent on them, and workers `crashed`. With `verbose`, we
+    also print the time taken by each item.
+    '''
+    if processes == 1:
+        return dict(_work(queue, process, max_attempts, verbose))
+    if isinstance(queue, LocalQueue):
+        raise TypeError("A LocalQueue can't be shared between processes. "
+                        "Use a MultiprocessingQueue or SQLiteQueue.")
+    results = multiprocessing.Queue()
+    running = {}
+
+    def start():
+        worker = multiprocessing.Process(target=_worker,
+                                         args=(queue, process, max_attempts,
+                                               verbose, results))
+        worker.start()
+        running[worker.pid] = worker
+
+    for i in range(processes):
+        start()
+    totals = collections.Counter(crashed=0)
+    while running:
+        try:
+            (pid, worker_totals) = results.get(timeout=1)
+            totals.update(worker_totals)
+            running.pop(pid).join()
+        except Queue.Empty:
+            # Workers which report exit cleanly. Anything else died
+            # mid-item; the item reappears once its timeout runs out.
+            for (pid, worker) in running.items():
+                if worker.exitcode not in (None, 0):
+                    del running[pid]
+                    totals['crashed'] += 1
+                    if totals['crashed'] <= processes * max_attempts:
+                        start()
+    return dict(totals)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
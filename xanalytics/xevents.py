@@ -7,7 +7,8 @@ import json
 import numbers
 import sys
 
-from xanalytics.streaming import token, __select_field
+from xanalytics.streaming import token, field_matcher, prefilter_text, \
+    text_to_json, time_key, _in_time_range, _time_key_range
 
 
 def decode_browser_event(data):
@@ -90,14 +91,47 @@ def date_gt_filter(data, date):
     '''
     Filter data based on date. Date is a pretty free-form string
     format. If date is None, this is a no-op.
+
+    Times are compared as strings (see `streaming.time_key`), so this
+    is fast for edX times.
+
+    >>> list(date_gt_filter([{"time": "2014-01-01T10:00:00+00:00"},
+    ...                      {"time": "2014-01-02T10:00:00+00:00"}],
+    ...                     "Jan 2 2014"))
+    [{'time': '2014-01-02T10:00:00+00:00'}]
     '''
     if not date:
         for line in data:
             yield line
+        return
+
+    date = time_key(date)
+    for line in data:
+        if time_key(line["time"]) > date:
+            yield line
 
-    date = dateutil.parser.parse(date)
+
+def date_between(data, start=None, end=None):
+    '''
+    Filter data to events from `start` (inclusive) up to `end`
+    (exclusive). Either may be None. As with date_gt_filter, these
+    are pretty free-form strings, so date_between(data, "2014-01-01",
+    "2014-02-01") gives January.
+
+    >>> [d["time"][:10] for d in date_between(
+    ...     [{"time": "2014-01-01T10:00:00+00:00"},
+    ...      {"time": "2014-01-31T10:00:00+00:00"},
+    ...      {"time": "2014-02-01T10:00:00+00:00"}],
+    ...     "2014-01-01", "2014-02-01")]
+    ['2014-01-01', '2014-01-31']
+    '''
+    if start is not None:
+        start = time_key(start)
+    if end is not None:
+        end = time_key(end)
     for line in data:
-        if dateutil.parser.parse(line["time"]) > date:
+        time = time_key(line["time"])
+        if (start is None or time >= start) and (end is None or time < end):
             yield line
 
 
@@ -121,6 +155,59 @@ def filter_on_courses(data, courses):
             yield d
 
 
+def select_events(data,
+                  event_types=None,
+                  courses=None,
+                  usernames=None,
+                  time_range=None):
+    '''
+    Decode and filter lines of text (e.g. from `read_data`) in one
+    step. Lines which can't match are dropped before JSON decoding
+    (see `streaming.prefilter_text`), which is much cheaper when we
+    only keep a small fraction of the events. The rest are decoded
+    and checked exactly.
+
+    `courses` are matched against context.course_id, as in
+    `filter_on_courses`. `time_range` is an inclusive (min, max) pair
+    of time strings; either may be None. Times are compared by
+    `streaming.time_key`.
+
+    >>> lines = ['{"event_type": "a", "username": "bob"}',
+    ...          '{"event_type": "b", "username": "bob"}',
+    ...          '{"event_type": "b", "username": "eve", "page": "bob"}']
+    >>> [e["event_type"] for e in select_events(lines, usernames=["bob"])]
+    [u'a', u'b']
+    >>> lines = ['{"time": "2014-01-02T05:00:00+02:00", "context": "x"}',
+    ...          '{"time": "2014-01-02T02:00:00+00:00", "context": {}}']
+    >>> [e["time"] for e in select_events(
+    ...     lines, time_range=("2014-01-02T03:00:00+00:00", None))]
+    [u'2014-01-02T05:00:00+02:00']
+    >>> list(select_events(lines, courses=["MITx/6.002x"]))
+    []
+    '''
+    tests = []
+    if event_types is not None:
+        event_types = frozenset(event_types)
+        tests.append(lambda d: d.get('event_type') in event_types)
+    if courses is not None:
+        courses = frozenset(courses)
+        # Some old events have a string for a context
+        tests.append(lambda d: isinstance(d.get('context'), dict) and
+                     d['context'].get('course_id') in courses)
+    if usernames is not None:
+        usernames = frozenset(usernames)
+        tests.append(lambda d: d.get('username') in usernames)
+    if time_range is not None:
+        key_range = _time_key_range(time_range)
+        tests.append(lambda d: d.get('time') is not None and
+                     _in_time_range(d['time'], key_range))
+
+    lines = prefilter_text(data, event_types, courses, usernames, time_range)
+    for d in text_to_json(lines):
+        if all(test(d) for test in tests):
+            yield d
+
+
 def filter_on_fields(data, field_spec):
     '''
     Filter through fields
@@ -128,14 +215,14 @@ def filter_on_fields(data, field_spec):
     field_spec maps field names to lists of possible values. For example:
     {'username':['jack','jill']}
     Will return all of the data where the user is either Jack or Jill
+
+    >>> list(filter_on_fields([{'username': 'jack'}, {'username': 'bob'}],
+    ...                       {'username': ['jack', 'jill']}))
+    [{'username': 'jack'}]
     '''
+    matches = field_matcher(field_spec)
     for d in data:  # d is the event
-        valid = True  # Does the event match the spec?
-        for field in field_spec:  # Field we're looking at
-            value = __select_field(d, field)
-            if value not in field_spec[field]:
-                valid = False
-        if valid:
+        if matches(d):
             yield d
 
 
@@ -1,33 +1,75 @@
 '''
 Download all processed tracking logs to local machine
+
+Downloads run in `--processes` worker processes, pulling key names
+from a shared queue. Files already downloaded are skipped, so an
+interrupted run can just be restarted.
+
+A worker which dies mid-download is replaced, and its file goes back
+on the queue once its (short) visibility timeout runs out; the
+heartbeat keeps files which are still downloading hidden. Workers wait
+past that timeout before they decide the queue is empty, and we keep
+going until every file is downloaded or has failed for good.
 '''
 
+import argparse
 import md5
 import os
 import os.path
 
-import boto.sqs
 from xanalytics.settings import settings
-from boto.sqs.message import Message
+from xanalytics.workqueue import MultiprocessingQueue, process_queue
 from boto.s3.connection import S3Connection
 
+_bucket = {}
+
+
+def bucket():
+    '''
+    The scratch bucket. Each worker process needs its own connection.
+    '''
+    if os.getpid() not in _bucket:
+        s3_conn = S3Connection(
+            aws_access_key_id=settings['edx-aws-access-key-id'],
+            aws_secret_access_key=settings['edx-aws-secret-key']
+        )
+        _bucket[os.getpid()] = s3_conn.get_bucket(settings["scratch-bucket"])
+    return _bucket[os.getpid()]
+
+
+def download(name):
+    filename = md5.new()
+    filename.update(name)
+    filename = "out/"+filename.hexdigest()
+    if not os.path.exists(filename):
+        bucket().get_key(name).get_contents_to_filename(filename + ".tmp")
+        os.rename(filename + ".tmp", filename)
+
 if __name__ == '__main__':
-    s3_conn = S3Connection(
-        aws_access_key_id=settings['edx-aws-access-key-id'],
-        aws_secret_access_key=settings['edx-aws-secret-key']
+    parser = argparse.ArgumentParser(description='Download processed logs.')
+    parser.add_argument(
+        '--processes',
+        dest='processes',
+        type=int,
+        default=8,
+        help='Downloads at once'
     )
-    bucket = s3_conn.get_bucket(settings["scratch-bucket"])
+    args = parser.parse_args()
 
-    l = list(bucket.list())
+    l = list(bucket().list())
     l = [i for i in l if i.name.startswith("forums/logs")]
     print "Total size", sum(i.size for i in l)
 
-    i = 0
-    for key in l:
-        filename = md5.new()
-        filename.update(key.name)
-        filename = "out/"+filename.hexdigest()
-        if not os.path.exists(filename):
-            key.get_contents_to_filename(filename)
-        i = i+1
-        print i
+    timeout = 30
+    queue = MultiprocessingQueue(visibility_timeout=timeout, wait=timeout * 2)
+    queue.send(key.name for key in l)
+    totals = process_queue(queue, download, processes=args.processes)
+    while queue.count():
+        # Files held by workers which died after the others gave up
+        print queue.count(), "files unfinished; retrying"
+        more = process_queue(queue, download, processes=args.processes)
+        for (name, value) in more.items():
+            totals[name] = totals.get(name, 0) + value
+    print totals['done'], "files,", totals['poisoned'], "failed"
+    for (name, error) in queue.dead_letters():
+        print "Failed:", name
@@ -1,7 +1,9 @@
 '''
 Take a list of all edX tracking logs in an S3 bucket.
 
-Dump that list to Amazon SQS for worker processes to pull from.
+Dump that list to Amazon SQS (or another `xanalytics.workqueue`) for
+worker processes to pull from, ten names per request, with several
+requests in flight.
 
 Example:
 
@@ -10,16 +12,12 @@ Example:
                         --queue edx-sqs-worker-queue
 '''
 
-import sys
-import os
 import argparse
 
-import boto.sqs
-from boto.sqs.message import Message
 from boto.s3.connection import S3Connection
 
 from xanalytics.settings import settings
-import xanalytics.multiprocess
+from xanalytics.workqueue import SQSQueue, open_queue
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Send a set of files to SQS.')
@@ -39,7 +37,14 @@ if __name__ == '__main__':
         '--queue',
         dest='queue',
         default=settings["tracking-logs-queue"],
-        help='SWS queue'
+        help='SQS queue name, or sqlite:<path> to run on one machine'
+    )
+    parser.add_argument(
+        '--threads',
+        dest='threads',
+        type=int,
+        default=8,
+        help='Batches to send at once'
     )
 
     args = parser.parse_args()
@@ -47,26 +52,11 @@ if __name__ == '__main__':
                            aws_secret_access_key=settings['edx-aws-secret-key'])
     bucket = s3_conn.get_bucket(args.bucket)
 
-    sqs_conn = boto.sqs.connect_to_region(
-        "us-east-1",
-        aws_access_key_id=settings['edx-aws-access-key-id'],
-        aws_secret_access_key=settings['edx-aws-secret-key']
-    )
-
-    source = bucket.list(prefix=args.prefix)
-    source = xanalytics.multiprocess.split(source, 100)
-
-    q = sqs_conn.get_queue(args.queue)
-
-    r = []
-
-    for key in source:
-        r.append(None)
-        if not key.name.startswith(args.prefix):
-            continue
-
-        m = Message()
-        m.set_body(key.name.encode('utf-8'))
-        q.write(m)
+    queue = open_queue(args.queue)
+    if isinstance(queue, SQSQueue):
+        queue.threads = args.threads
 
-    xanalytics.multiprocess.join(r)
+    names = (key.name.encode('utf-8')
+             for key in bucket.list(prefix=args.prefix)
+             if key.name.startswith(args.prefix))
+    print queue.send(names), "files queued"
@@ -4,8 +4,16 @@ tracking logs into a new bucket.
 
 This script consists of two pieces:
 
-1) Send all the tracking logs to an SQS queue
-2) Process all the tracking logs from the SQS queue
+1) Send all the tracking logs to a queue (logs_to_sqs.py)
+2) Process all the tracking logs from the queue
+
+The queue can be SQS, to run across a cluster, or an SQLite queue
+(`--queue sqlite:/path/to/queue.db`), to run on all the cores of one
+machine. Each file gets `--attempts` tries before we give up on it.
+
+Files are streamed and filtered as they download, and all the users
+are matched in a single pass over each line (see
+`streaming.MultiMatcher`), so this scales to large cohorts.
 
 As a ballpark, this script ought to take about a day of machine time
 on a fast machine per terabyte of tracking logs (estimated, not from
@@ -14,12 +22,14 @@ doing something wrong here or elsewhere.
 '''
 
 
+import argparse
 import uuid
 import gzip
 import os
-import boto.sqs
+from xanalytics.gzipfs import codecs
 from xanalytics.settings import settings
-from boto.sqs.message import Message
+from xanalytics.streaming import select_users
+from xanalytics.workqueue import open_queue, process_queue
 from boto.s3.connection import S3Connection
 
 if __name__ == '__main__':
@@ -27,7 +37,6 @@ if __name__ == '__main__':
         aws_access_key_id=settings['edx-aws-access-key-id'],
         aws_secret_access_key=settings['edx-aws-secret-key']
     )
-    temp = uuid.uuid1().hex
 
     users = [x.strip()
              for x
@@ -35,47 +44,55 @@ if __name__ == '__main__':
 
 
 def process(item):
-    outfile = uuid.uuid1().hex+".gz"
-    dest = gzip.open(outfile, "w")
+    """
+    Stream one log file from S3, and upload the lines which mention
+    any of our users. Prints how many lines matched each user.
+    """
     source_bucket = s3_conn.get_bucket(settings['tracking-logs-bucket'])
     key = source_bucket.get_key(item)
-    filename = "/tmp/log_"+uuid.uuid1().hex+".log"
-    key.get_contents_to_filename(filename)
-    try:
-        lines = gzip.open(filename).readlines()
-    except IOError:
-        lines = open(filename).readlines()
-    for line in lines:
-        good = False
-        for user in users:
-            if user in line:
-                good = True
-        if good:
-            dest.write(line)
+    outfile = uuid.uuid1().hex+".gz"
+    dest = gzip.open(outfile, "w")
+    counts = {}
+    dest.writelines(select_users(codecs.stream_reader(key), users, counts))
     dest.close()
+    key.close()
     outbucket = s3_conn.get_bucket(settings['scratch-bucket'])
     k = outbucket.new_key("forums/"+item)
     k.set_contents_from_filename(outfile)
     os.unlink(outfile)
-    os.unlink(filename)
+    print item, sum(counts.values()), "lines,", len(counts), "users"
+    for user in sorted(counts):
+        print "   ", user, counts[user]
     return key.size
 
 if __name__ == '__main__':
-    i = 0
-    d = 0
-
-    sqs_conn = boto.sqs.connect_to_region(
-        "us-east-1",
-        aws_access_key_id=settings['edx-aws-access-key-id'],
-        aws_secret_access_key=settings['edx-aws-secret-key']
+    parser = argparse.ArgumentParser(
+        description='Filter users out of queued tracking logs.')
+    parser.add_argument(
+        '--queue',
+        dest='queue',
+        default=settings["tracking-logs-queue"],
+        help='SQS queue name, or sqlite:<path> to run on one machine'
     )
-    q = sqs_conn.get_queue(settings["tracking-logs-queue"])
-    while q.count() > 0:
-        m = q.read(60*10)
-        b = m.get_body()
-        i = i+1
-        print b
-        s = process(b)
-        d = d + s
-        print i, "files", b, d/1.e9, "GB"
-        q.delete_message(m)
+    parser.add_argument(
+        '--processes',
+        dest='processes',
+        type=int,
+        default=1,
+        help='Worker processes'
+    )
+    parser.add_argument(
+        '--attempts',
+        dest='attempts',
+        type=int,
+        default=3,
+        help='Tries per file'
+    )
+    args = parser.parse_args()
+
+    totals = process_queue(open_queue(args.queue, visibility_timeout=60 * 10),
+                           process,
+                           processes=args.processes,
+                           max_attempts=args.attempts)
+    print totals['done'], "files in", totals['seconds'], "seconds"
+    print totals['retried'], "retries,", totals['poisoned'], "failed"